@@ -0,0 +1,202 @@
+import os
+import csv
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from campaign_zero.analysis.shrinkage import fit_grouped, panel_arrays
+from campaign_zero.data_preprocessing.panel import group_ranges
+
+
+# Arrays shared with worker processes, set by attach_shared.
+SHARED = {}
+
+
+def share_arrays(arrays):
+
+    """ Copies a dictionary of arrays into shared memory blocks. Returns the
+        blocks, which the caller must close and unlink, and a description
+        of the arrays for attach_shared.
+    """
+
+    blocks = []
+    descriptions = {}
+    for key, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        blocks += [block]
+        descriptions[key] = (block.name, array.shape, array.dtype.str)
+    return blocks, descriptions
+
+
+def attach_shared(descriptions):
+
+    """ Worker initializer, mapping the arrays from share_arrays into SHARED
+        without copying them.
+    """
+
+    for key, (name, shape, dtype) in descriptions.items():
+        block = shared_memory.SharedMemory(name=name)
+        SHARED[key + '_block'] = block
+        SHARED[key] = np.ndarray(shape, np.dtype(dtype), buffer=block.buf)
+
+    return
+
+
+def rank_percentiles(values):
+
+    """ Returns each value's rank as a fraction, 0 for the highest value
+        and 1 for the lowest, with ties sharing their mean rank.
+    """
+
+    if len(values) < 2:
+        return np.zeros(len(values))
+    order = np.argsort(-values, kind='stable')
+    ranks = np.empty(len(values))
+    ranks[order] = np.arange(len(values))
+    unique_values, inverse = np.unique(values, return_inverse=True)
+    mean_ranks = np.bincount(inverse, weights=ranks) / np.bincount(inverse)
+    return mean_ranks[inverse] / (len(values) - 1)
+
+
+def run_replicates(kind, seed, batch, replicates, family, coefficients):
+
+    """ Runs one batch of bootstrap or permutation replicates on the shared
+        panel, seeded by (seed, batch) so results do not depend on how
+        batches are spread over workers. Returns a (replicates, officers)
+        array. For 'bootstrap', officers are resampled with replacement by
+        police_id, and each drawn officer gets the mean rank percentile of
+        their copies, or NaN if not drawn. For 'permutation', counts and
+        their fixed effects are shuffled across periods, and each officer
+        gets their condval under that null.
+    """
+
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(batch,)))
+    counts, design = SHARED['counts'], SHARED['design']
+    owners, offsets = SHARED['owners'], SHARED['offsets']
+    num_officers = len(offsets) - 1
+    periods = offsets[1:] - offsets[:-1]
+    results = np.full((replicates, num_officers), np.nan)
+
+    for replicate in range(replicates):
+        if kind == 'bootstrap':
+            sampled = rng.integers(0, num_officers, num_officers)
+            lengths = periods[sampled]
+            rows = group_ranges(offsets[sampled], lengths)
+            clusters = np.repeat(np.arange(num_officers), lengths)
+            fit = fit_grouped(counts[rows], design[rows], clusters, num_officers,
+                family, coefficients=coefficients)
+            percentiles = rank_percentiles(fit['condval'])
+            draws = np.bincount(sampled, minlength=num_officers)
+            drawn = draws > 0
+            results[replicate, drawn] = (np.bincount(sampled, weights=percentiles,
+                minlength=num_officers)[drawn] / draws[drawn])
+        else:
+            rows = rng.permutation(len(counts))
+            fit = fit_grouped(counts[rows], design[rows], owners, num_officers,
+                family, coefficients=coefficients)
+            results[replicate] = fit['condval']
+
+    return results
+
+
+def run_pool(kind, replicates, seed, processes, batch_size, family,
+        coefficients, descriptions, num_officers):
+
+    if not replicates:
+        return np.zeros((0, num_officers))
+    batches = [min(batch_size, replicates - start) for start in range(0, replicates, batch_size)]
+    with ProcessPoolExecutor(max_workers=processes, initializer=attach_shared,
+            initargs=(descriptions,)) as executor:
+        futures = [executor.submit(run_replicates, kind, seed, batch, size,
+            family, coefficients) for batch, size in enumerate(batches)]
+        return np.concatenate([future.result() for future in futures])
+
+
+def rank_stability(panel, bootstrap_replicates=1000, permutation_replicates=1000,
+        top_k=100, seed=0, processes=None, batch_size=25,
+        allegation_column='civilian_allegations',
+        fixed_effects=(('division', True), ('experience', False)), family='nbinom1',
+        interval=0.95):
+
+    """ Estimates how stable each officer's shrunken_metric ranking is.
+        Officers are ranked 1 for the highest condval. A cluster bootstrap
+        by police_id gives each officer an interval of ranks over the
+        replicates they were drawn in, and the share of those replicates in
+        which they ranked in the top top_k. A permutation null, shuffling
+        periods across officers, gives each officer the share of null
+        replicates in which their condval was at least as high as observed.
+        Replicates run in batches across a process pool, with the panel
+        arrays in shared memory and each batch seeded from seed and its
+        batch number, so results only depend on seed and batch_size.
+    """
+
+    rows, police_ids, owners, counts, design = panel_arrays(panel,
+        allegation_column, fixed_effects)
+    num_officers = len(police_ids)
+    observed = fit_grouped(counts, design, owners, num_officers, family)
+
+    # Group each officer's periods together, so resampling an officer
+    # selects one contiguous range of rows.
+    order = np.argsort(owners, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(owners, minlength=num_officers))])
+    blocks, descriptions = share_arrays({'counts': counts[order],
+        'design': design[order], 'owners': owners[order], 'offsets': offsets})
+    try:
+        bootstrap = run_pool('bootstrap', bootstrap_replicates, seed, processes,
+            batch_size, family, observed['coefficients'], descriptions, num_officers)
+        permutation = run_pool('permutation', permutation_replicates, seed + 1,
+            processes, batch_size, family, observed['coefficients'], descriptions,
+            num_officers)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    # Bootstrap rank percentiles back on the scale of ranks 1 to officers.
+    bootstrap_ranks = 1 + bootstrap * (num_officers - 1)
+    drawn = np.sum(~np.isnan(bootstrap_ranks), axis=0)
+    tail = (1 - interval) / 2
+    with np.errstate(invalid='ignore'):
+        if bootstrap_replicates:
+            rank_lower, rank_upper = np.nanquantile(bootstrap_ranks, [tail, 1 - tail], axis=0)
+        else:
+            rank_lower = rank_upper = np.full(num_officers, np.nan)
+        top_k_share = np.sum(bootstrap_ranks <= top_k, axis=0) / drawn
+    exceed = np.sum(permutation >= observed['condval'], axis=0)
+
+    return {
+        'police_ids': police_ids,
+        'condval': observed['condval'],
+        'reliability': observed['reliability'],
+        'rank': 1 + rank_percentiles(observed['condval']) * (num_officers - 1),
+        'rank_lower': rank_lower,
+        'rank_upper': rank_upper,
+        'top_k': top_k,
+        'top_k_share': top_k_share,
+        'bootstrap_draws': drawn,
+        'permutation_p': (1 + exceed) / (1 + permutation_replicates)}
+
+
+def write_rank_stability(output_data_folder, stability, prefix='nashville'):
+
+    """ Writes one row per officer of the results of rank_stability, most
+        highly ranked first.
+    """
+
+    output_filename = os.path.join(output_data_folder, f'{prefix}_rank_stability.csv')
+    with open(output_filename, 'w', newline='') as outfile:
+        writer = csv.writer(outfile, delimiter=',')
+        header = ['police_id', 'shrunken_metric', 'reliability', 'rank',
+            'rank_lower', 'rank_upper', f'top_{stability["top_k"]}_share',
+            'bootstrap_draws', 'permutation_p']
+        writer.writerow(header)
+        columns = ['condval', 'reliability', 'rank', 'rank_lower', 'rank_upper',
+            'top_k_share', 'bootstrap_draws', 'permutation_p']
+        for idx in np.argsort(stability['rank'], kind='stable').tolist():
+            writer.writerow([stability['police_ids'][idx]] +
+                [stability[column][idx].item() for column in columns])
+
+    return
@@ -0,0 +1,328 @@
+import os
+import numpy as np
+
+
+RANDOM_EFFECTS_HEADER = ['grpvar', 'term', 'grp', 'condval', 'condsd']
+TIME_PERIOD_HEADER = ['police_id', 'component', 'grpvar', 'term', 'condval',
+    'condsd', 'n', 'residual', 'predictions', 'complaints',
+    'residual_randomeffect', 'condsd_transformed', 'predictions_transformed',
+    'full_name', 'force_count']
+POLICE_ID_HEADER = ['police_id', 'component', 'grpvar', 'term', 'condval',
+    'condsd', 'n', 'residual', 'predictions', 'complaints',
+    'residual_randomeffect', 'condsd_transformed', 'predictions_transformed',
+    'full_name.x', 'force_count', 'x', 'full_name.y', 'reliability',
+    'shrunken_metric', 'shrunken_metric2']
+
+
+def shift_up(x, minimum=10.0):
+
+    """ Returns (x + k, k) with the smallest whole k that brings every
+        value of x to at least minimum, for the recurrences below.
+    """
+
+    x = np.array(x, dtype=np.float64)
+    shifts = np.maximum(np.ceil(minimum - x), 0)
+    return x + shifts, shifts
+
+
+def log_gamma(x):
+
+    """ log(Gamma(x)) for positive x, via the Stirling series.
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    shifted, shifts = shift_up(x)
+    correction = np.zeros_like(shifted)
+    for k in range(int(shifts.max()) if shifts.size else 0):
+        correction += np.where(shifts > k, np.log(x + k), 0)
+    inverse = 1 / shifted
+    series = inverse * (1 / 12 - inverse ** 2 * (1 / 360 - inverse ** 2 *
+        (1 / 1260 - inverse ** 2 / 1680)))
+    return (shifted - 0.5) * np.log(shifted) - shifted + 0.5 * np.log(2 * np.pi) + \
+        series - correction
+
+
+def digamma(x):
+
+    x = np.asarray(x, dtype=np.float64)
+    shifted, shifts = shift_up(x)
+    correction = np.zeros_like(shifted)
+    for k in range(int(shifts.max()) if shifts.size else 0):
+        correction += np.where(shifts > k, 1 / (x + k), 0)
+    inverse = 1 / shifted ** 2
+    series = inverse * (1 / 12 - inverse * (1 / 120 - inverse * (1 / 252 -
+        inverse * (1 / 240 - inverse / 132))))
+    return np.log(shifted) - 0.5 / shifted - series - correction
+
+
+def trigamma(x):
+
+    x = np.asarray(x, dtype=np.float64)
+    shifted, shifts = shift_up(x)
+    correction = np.zeros_like(shifted)
+    for k in range(int(shifts.max()) if shifts.size else 0):
+        correction += np.where(shifts > k, 1 / (x + k) ** 2, 0)
+    inverse = 1 / shifted
+    series = inverse ** 3 * (1 / 6 - inverse ** 2 * (1 / 30 - inverse ** 2 *
+        (1 / 42 - inverse ** 2 / 30)))
+    return inverse + 0.5 * inverse ** 2 + series + correction
+
+
+def design_matrix(panel, rows, fixed_effects):
+
+    """ Builds an intercept, one column per non-reference level of each
+        categorical fixed effect, and standardized numeric fixed effects.
+    """
+
+    columns = [np.ones(len(rows))]
+    for fixed_effect, categorical in fixed_effects:
+        values = np.asarray(panel[fixed_effect])[rows]
+        if categorical:
+            levels, codes = np.unique(values, return_inverse=True)
+            columns += [(codes == level).astype(np.float64) for level in range(1, len(levels))]
+        else:
+            values = values.astype(np.float64)
+            spread = values.std(ddof=1) if len(values) > 1 else 0
+            columns += [(values - values.mean()) / (spread if spread > 0 else 1)]
+    return np.column_stack(columns)
+
+
+def fit_poisson(counts, design, offset, coefficients=None, iterations=50,
+        tolerance=1e-10):
+
+    """ Fits Poisson regression coefficients by iteratively reweighted least
+        squares, starting from coefficients if given.
+    """
+
+    if coefficients is None:
+        coefficients = np.zeros(design.shape[1])
+        coefficients[0] = np.log(max(counts.mean(), 1e-10)) - offset.mean()
+    for iteration in range(iterations):
+        eta = design @ coefficients + offset
+        mu = np.exp(eta)
+        working = eta - offset + (counts - mu) / mu
+        weighted = design * mu[:, None]
+        updated = np.linalg.lstsq(design.T @ weighted, weighted.T @ working,
+            rcond=None)[0]
+        converged = np.abs(updated - coefficients).max() < tolerance
+        coefficients = updated
+        if converged:
+            break
+    return coefficients
+
+
+def fit_gamma_shape(totals, exposures, lower=-10.0, upper=12.0, iterations=60):
+
+    """ Maximizes the negative binomial marginal likelihood of officer
+        totals over the shape of a mean one gamma random intercept, by
+        golden section search on its log. Totals take few distinct values,
+        so the log gamma terms are evaluated once per value.
+    """
+
+    unique_totals, total_counts = np.unique(totals, return_counts=True)
+
+    def log_likelihood(log_shape):
+        shape = np.exp(log_shape)
+        return np.sum(total_counts * (log_gamma(shape + unique_totals) - log_gamma(shape))) + \
+            np.sum(shape * np.log(shape) - (shape + totals) * np.log(shape + exposures))
+
+    ratio = (np.sqrt(5) - 1) / 2
+    left, right = upper - ratio * (upper - lower), lower + ratio * (upper - lower)
+    left_value, right_value = log_likelihood(left), log_likelihood(right)
+    for iteration in range(iterations):
+        if left_value > right_value:
+            upper, right, right_value = right, left, left_value
+            left = upper - ratio * (upper - lower)
+            left_value = log_likelihood(left)
+        else:
+            lower, left, left_value = left, right, right_value
+            right = lower + ratio * (upper - lower)
+            right_value = log_likelihood(right)
+    return float(np.exp((lower + upper) / 2))
+
+
+def fit_grouped(counts, design, owners, num_officers, family='nbinom1',
+        iterations=10, coefficients=None, tolerance=1e-8):
+
+    """ Fits the model of fit_shrinkage to counts, their fixed effects design
+        rows and officer codes in owners, returning the per officer
+        posteriors and the fitted parameters. Pass the coefficients of an
+        earlier fit to start from them. Stops early once the offsets and
+        the dispersion change by less than tolerance, relative to the
+        dispersion for the latter.
+    """
+
+    if family not in ['poisson', 'nbinom1']:
+        raise ValueError(f'Unknown family {family!r}')
+
+    periods = np.bincount(owners, minlength=num_officers)
+    totals = np.bincount(owners, weights=counts, minlength=num_officers)
+
+    offset = np.zeros(len(counts))
+    dispersion = 1.0
+    shape = 1.0
+    for iteration in range(iterations):
+        coefficients = fit_poisson(counts, design, offset, coefficients)
+        expected = np.exp(design @ coefficients)
+        exposures = np.bincount(owners, weights=expected, minlength=num_officers)
+        shape = fit_gamma_shape(totals / dispersion, exposures / dispersion)
+        posterior_means = (shape + totals / dispersion) / (shape + exposures / dispersion)
+        previous_offset, previous_dispersion = offset, dispersion
+        offset = np.log(posterior_means)[owners]
+        if family == 'nbinom1':
+            # Given its total, an officer's counts spread over their periods
+            # in proportion to expected, and the sum of squared deviations
+            # from that spread, each divided by its proportion, has
+            # expectation dispersion * total * (periods - 1).
+            shares = expected / exposures[owners]
+            spread = np.bincount(owners, weights=counts ** 2 / shares,
+                minlength=num_officers) - totals ** 2
+            degrees = np.sum(totals * (periods - 1))
+            if degrees > 0:
+                dispersion = max(spread.sum() / degrees, 1.0)
+        if np.abs(offset - previous_offset).max() < tolerance and \
+                abs(dispersion - previous_dispersion) <= \
+                tolerance * max(1.0, abs(previous_dispersion)):
+            break
+
+    posterior_shapes = shape + totals / dispersion
+    posterior_rates = shape + exposures / dispersion
+
+    return {'periods': periods, 'totals': totals, 'exposures': exposures,
+        'coefficients': coefficients, 'shape': shape, 'dispersion': dispersion,
+        'condval': digamma(posterior_shapes) - np.log(posterior_rates),
+        'condsd': np.sqrt(trigamma(posterior_shapes)),
+        'reliability': (exposures / dispersion) / (shape + exposures / dispersion)}
+
+
+def panel_arrays(panel, allegation_column='civilian_allegations',
+        fixed_effects=(('division', True), ('experience', False))):
+
+    """ Returns (rows, police_ids, owners, counts, design) for the
+        non-switch periods of a panel from build_model_panel.
+    """
+
+    rows = np.flatnonzero(~np.asarray(panel['switch'], dtype=bool))
+    counts = np.asarray(panel[allegation_column], dtype=np.float64)[rows]
+    police_ids, owners = np.unique(np.asarray(panel['police_id'])[rows], return_inverse=True)
+    design = design_matrix(panel, rows, fixed_effects)
+    return rows, police_ids.tolist(), owners, counts, design
+
+
+def fit_shrinkage(panel, allegation_column='civilian_allegations',
+        fixed_effects=(('division', True), ('experience', False)),
+        family='nbinom1', iterations=10):
+
+    """ Fits a random intercept count model to the non-switch periods of a
+        panel from build_model_panel, by officer. Each officer's rate is
+        exp(fixed effects) times a mean one gamma random intercept, so the
+        officer totals are negative binomial and every officer's posterior
+        follows from their total allegations and total expected count.
+        The fixed effects, given as (column, categorical) pairs, and the
+        gamma shape are re-estimated in turn. With family 'nbinom1', counts
+        are further overdispersed within officers by a constant factor,
+        estimated from how each officer's total spreads over their periods
+        and divided out of the totals; 'poisson' leaves them as they are.
+
+        condval and condsd are the posterior mean and standard deviation of
+        the log random intercept. reliability is the weight the posterior
+        mean gives the officer's own rate over the department's, and
+        shrunken_metric is condval, which is already shrunk by it.
+    """
+
+    rows, police_ids, owners, counts, design = panel_arrays(panel,
+        allegation_column, fixed_effects)
+    results = fit_grouped(counts, design, owners, len(police_ids), family, iterations)
+    predictions = design @ results['coefficients'] + results['condval'][owners]
+    results.update({'police_ids': police_ids, 'owners': owners, 'rows': rows,
+        'counts': counts, 'predictions': predictions,
+        'residuals': counts - np.exp(predictions)})
+    return results
+
+
+def format_r_value(value):
+
+    """ Formats a value the way R's write.csv does.
+    """
+
+    if value is None:
+        return 'NA'
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    if isinstance(value, (bool, np.bool_)):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float) and not np.isfinite(value):
+        return 'NA' if np.isnan(value) else ('Inf' if value > 0 else '-Inf')
+    if not isinstance(value, (int, float, np.number)):
+        return format_r_value(str(value))
+    return '%.15g' % value
+
+
+def write_r_csv(output_filename, header, rows):
+
+    """ Writes rows like R's write.csv, with quoted row names in front.
+    """
+
+    with open(output_filename, 'w') as outfile:
+        outfile.write(','.join(format_r_value(x) for x in [''] + header) + '\n')
+        for idx, row in enumerate(rows):
+            outfile.write(','.join(format_r_value(x) for x in [str(idx + 1)] + list(row)) + '\n')
+
+    return
+
+
+def write_shrinkage_results(output_data_folder, panel, results, prefix='nashville'):
+
+    """ Writes the random effects, time period and police ID results
+        spreadsheets that r_analysis/nashville/mixed_model.r produced.
+    """
+
+    police_ids = results['police_ids']
+    owners = results['owners']
+    rows = results['rows']
+    condval, condsd = results['condval'], results['condsd']
+    write_r_csv(os.path.join(output_data_folder, f'{prefix}_random_effects.csv'),
+        RANDOM_EFFECTS_HEADER, [('police_id', '(Intercept)', police_id,
+            float(condval[idx]), float(condsd[idx])) for idx, police_id in enumerate(police_ids)])
+
+    # Time period results, grouped by officer.
+    order = np.argsort(owners, kind='stable')
+    # Officers without allegations have no name, which the model
+    # spreadsheets write as '[]'.
+    full_names = [x if isinstance(x, str) else str(x) for x in
+        (panel['full_name'][idx] for idx in rows.tolist())]
+    force_counts = np.asarray(panel['force_count'], dtype=np.float64)[rows]
+    residual_randomeffect = results['residuals'] + np.exp(condval[owners])
+    columns = {
+        'condval': condval[owners], 'condsd': condsd[owners],
+        'n': results['periods'][owners].astype(np.float64),
+        'residual': results['residuals'], 'predictions': results['predictions'],
+        'complaints': results['counts'], 'residual_randomeffect': residual_randomeffect,
+        'condsd_transformed': np.exp(condsd[owners]),
+        'predictions_transformed': np.exp(results['predictions']),
+        'force_count': force_counts}
+    write_r_csv(os.path.join(output_data_folder, f'{prefix}_time_period_results.csv'),
+        TIME_PERIOD_HEADER, [[police_ids[owners[idx]], 'cond', 'police_id', '(Intercept)'] +
+            [float(columns[key][idx]) for key in TIME_PERIOD_HEADER[4:13]] +
+            [full_names[idx], float(force_counts[idx])] for idx in order.tolist()])
+
+    # Officer means of the time period results.
+    periods = results['periods'].astype(np.float64)
+    means = {key: np.bincount(owners, weights=value, minlength=len(police_ids)) / periods
+        for key, value in columns.items()}
+    squares = np.bincount(owners, weights=(results['residuals'] -
+        means['residual'][owners]) ** 2, minlength=len(police_ids))
+    residual_sd = np.where(periods > 1, np.sqrt(squares / np.maximum(periods - 1, 1)), np.nan)
+    names = [[] for police_id in police_ids]
+    for idx in order.tolist():
+        names[owners[idx]] += [full_names[idx]]
+    reliability = results['reliability']
+    write_r_csv(os.path.join(output_data_folder, f'{prefix}_police_id_results.csv'),
+        POLICE_ID_HEADER, [[police_id, None, None, None] +
+            [float(means[key][idx]) for key in POLICE_ID_HEADER[4:13]] +
+            [None, float(means['force_count'][idx]), float(residual_sd[idx]),
+                ','.join(names[idx]), float(reliability[idx]), float(condval[idx]),
+                float(means['residual_randomeffect'][idx] * reliability[idx])]
+            for idx, police_id in enumerate(police_ids)])
+
+    return
@@ -0,0 +1,60 @@
+import os
+import tempfile
+
+from datetime import datetime
+
+from campaign_zero.data_preprocessing.departments import NASHVILLE
+from campaign_zero.data_preprocessing.instrumentation import RunRecorder
+from campaign_zero.data_preprocessing.preprocess import preprocess_department
+from campaign_zero.data_preprocessing.synthetic import generate_department
+
+
+def benchmark_stages(input_data_folder, output_data_folder, department=NASHVILLE,
+        period_length=180, period_start_date=datetime(2009, 1, 1),
+        period_end_date=datetime(2018, 7, 18), trace_memory=True):
+
+    """ Runs preprocess_department and returns its per stage records from
+        the run manifest. Switch derivation happens while the OfficerTable
+        is built, so it is timed with load_assignments. With trace_memory,
+        each stage also records its peak traced allocation, which slows
+        every stage down, so compare timings taken with the same setting.
+    """
+
+    recorder = RunRecorder('tracemalloc' if trace_memory else None)
+    preprocess_department(department, input_data_folder, output_data_folder,
+        period_length, period_start_date, period_end_date, recorder=recorder)
+
+    return recorder.stages
+
+
+def run_benchmarks(scales=(1, 10, 100), working_folder=None, seed=0,
+        trace_memory=True):
+
+    """ Generates synthetic data at each multiple of the Nashville data's
+        size and benchmarks every stage on it. Prints a table and returns
+        a dictionary of results by scale.
+    """
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        working_folder = working_folder or temp_folder
+        all_results = {}
+        for scale in scales:
+            input_data_folder = os.path.join(working_folder, f'scale_{scale}', 'input')
+            output_data_folder = os.path.join(working_folder, f'scale_{scale}', 'output')
+            os.makedirs(output_data_folder, exist_ok=True)
+            generate_department(input_data_folder, scale=scale, seed=seed)
+            all_results[scale] = benchmark_stages(input_data_folder,
+                output_data_folder, trace_memory=trace_memory)
+
+            print(f'Scale {scale}x')
+            for result in all_results[scale]:
+                peak = '' if 'peak_traced_bytes' not in result else \
+                    '{:10.1f} MB'.format(result['peak_traced_bytes'] / 1024 ** 2)
+                print('  {:<20}{:10.3f} s{}'.format(result['stage'], result['seconds'], peak))
+
+    return all_results
+
+
+if __name__ == '__main__':
+
+    run_benchmarks()
@@ -0,0 +1,102 @@
+import os
+import glob
+import hashlib
+import numpy as np
+
+
+# Bump this whenever a parser's output changes, so stale entries are ignored.
+PARSER_VERSION = 4
+
+
+class ParseCache(object):
+
+    """ Caches parsed spreadsheets as compressed .npz files, keyed by the
+        input file's content hash, the parser's name and arguments and
+        PARSER_VERSION. Entries are evicted least recently used first once
+        the cache folder grows past max_bytes.
+    """
+
+    def __init__(self, cache_folder, max_bytes=1024 ** 3):
+
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def key(self, input_filename, parser, *args):
+
+        content_hash = hashlib.sha256()
+        content_hash.update(f'{parser.__name__}{args!r}:{PARSER_VERSION}:'.encode())
+        with open(input_filename, 'rb') as openfile:
+            for chunk in iter(lambda: openfile.read(1024 ** 2), b''):
+                content_hash.update(chunk)
+        return content_hash.hexdigest()
+
+    def cache_filename(self, input_filename, parser, *args):
+
+        return os.path.join(self.cache_folder,
+            self.key(input_filename, parser, *args) + '.npz')
+
+    def parse(self, input_filename, parser, *args):
+
+        """ Returns parser(input_filename, *args), a dictionary of arrays,
+            from the cache if this content has been parsed before.
+        """
+
+        # Other processes sharing the folder may evict the entry at any
+        # point, which counts as a miss.
+        cache_filename = self.cache_filename(input_filename, parser, *args)
+        try:
+            os.utime(cache_filename)
+            with np.load(cache_filename) as cached:
+                return {key: cached[key] for key in cached.files}
+        except FileNotFoundError:
+            pass
+
+        # Temporary files are named so the '*.npz' globs never match them.
+        columns = parser(input_filename, *args)
+        temp_filename = f'{cache_filename}.{os.getpid()}.tmp'
+        with open(temp_filename, 'wb') as outfile:
+            np.savez_compressed(outfile, **columns)
+        os.replace(temp_filename, cache_filename)
+        self.evict()
+        return columns
+
+    def invalidate(self, input_filename, parser, *args):
+
+        """ Removes the entry for the current content of input_filename.
+        """
+
+        try:
+            os.remove(self.cache_filename(input_filename, parser, *args))
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+
+        for cache_filename in glob.glob(os.path.join(self.cache_folder, '*.npz')):
+            try:
+                os.remove(cache_filename)
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+
+        """ Deletes least recently used entries until under max_bytes.
+        """
+
+        entries = []
+        for cache_filename in glob.glob(os.path.join(self.cache_folder, '*.npz')):
+            try:
+                stat = os.stat(cache_filename)
+            except FileNotFoundError:
+                continue
+            entries += [(stat.st_mtime, stat.st_size, cache_filename)]
+        total_bytes = sum(x[1] for x in entries)
+        for mtime, size, cache_filename in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(cache_filename)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
@@ -0,0 +1,206 @@
+import csv
+import numpy as np
+
+from contextlib import contextmanager
+from datetime import datetime
+
+
+OUTPUT_FORMATS = ['csv', 'parquet']
+
+# Column types for the parquet outputs. Columns not listed are written as
+# strings. Values that do not fit a column's type, such as the '[]' of
+# missing officers or 'Unassigned' ages, are written as nulls.
+COLUMN_KINDS = {
+    # Extended allegations
+    'duplicate_control': 'bool', 'age': 'int', 'gender': 'category',
+    'race': 'category', 'bureau': 'category', 'division': 'category',
+    'section': 'category', 'experience': 'int', 'during_assignment': 'bool',
+    'personnel_lname': 'category', 'personnel_fname': 'category',
+    'personnel_race': 'category', 'Complainant_Sex': 'category',
+    'Complainant_Race': 'category', 'infraction': 'category',
+    'ViolationCode': 'category', 'Originated': 'category',
+    'disposition': 'category', 'incident_type': 'category',
+    # Employees
+    'emp_id': 'category', 'name': 'category', 'first_name': 'category',
+    'last_name': 'category', 'max_age': 'int', 'missing': 'bool',
+    'start_date': 'date', 'end_date': 'date', 'hire_date': 'date',
+    'max_experience': 'int', 'days_assigned': 'int', 'switches': 'int',
+    'community_switches': 'int', 'force_count': 'int',
+    'allegation_count_assignment': 'int',
+    'civilian_allegation_count_assignment': 'int', 'allegation_count': 'int',
+    'civilian_allegation_count': 'int',
+    # Model panels
+    'police_id': 'category', 'time_period': 'int', 'allegations': 'int',
+    'full_name': 'category'}
+for field in ['switches', 'community_switches', 'allegation_count_assignment',
+        'civilian_allegation_count_assignment', 'allegation_count',
+        'civilian_allegation_count', 'allegation_assignment',
+        'civilian_allegation_assignment', 'allegation', 'civilian_allegation',
+        'civlian_allegation']:
+    for unit in ['day', 'year']:
+        COLUMN_KINDS[f'{field}_per_{unit}'] = 'float'
+
+# The model panels hold integer codes where the other outputs hold names.
+MODEL_COLUMN_KINDS = dict(COLUMN_KINDS, division='int', race='int',
+    gender='int', age='int', experience='int', switch='bool',
+    allegations_lag1='int', prior_allegations='int', force_lag1='int',
+    prior_force='int')
+
+
+def import_pyarrow():
+
+    """ pyarrow is only needed for parquet outputs, so it is imported on
+        first use.
+    """
+
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Writing parquet outputs requires pyarrow, '
+            'install it with pip install pyarrow')
+    return pyarrow
+
+
+def output_filename(stem, output_format='csv'):
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'Unknown output format {output_format!r}, '
+            f'expected one of {OUTPUT_FORMATS}')
+    return f'{stem}.{output_format}'
+
+
+def column_array(values, kind):
+
+    """ Converts a list of values to a typed arrow array, with nulls for
+        values that do not fit kind. Categories are dictionary encoded.
+    """
+
+    pa = import_pyarrow()
+    if kind == 'bool':
+        values = [x if isinstance(x, (bool, np.bool_)) else None for x in values]
+        return pa.array(values, pa.bool_())
+    if kind == 'int':
+        values = [x if isinstance(x, (int, np.integer)) and not isinstance(x, bool)
+            else None for x in values]
+        return pa.array(values, pa.int64())
+    if kind == 'float':
+        values = [x if isinstance(x, (int, float, np.number)) and not isinstance(x, bool)
+            else None for x in values]
+        return pa.array(values, pa.float64())
+    if kind == 'date':
+        values = [x if isinstance(x, datetime) else None for x in values]
+        return pa.array(values, pa.timestamp('s'))
+    values = [x if isinstance(x, str) else None for x in values]
+    if kind == 'category':
+        return pa.array(values, pa.string()).dictionary_encode()
+    return pa.array(values, pa.string())
+
+
+def unique_names(header):
+
+    """ Parquet columns need unique names, so repeats of a name in header,
+        like the two during_assignment columns of the extended allegations,
+        are suffixed with their count.
+    """
+
+    seen = {}
+    names = []
+    for name in header:
+        seen[name] = seen.get(name, 0) + 1
+        names += [name if seen[name] == 1 else f'{name}_{seen[name]}']
+    return names
+
+
+def column_table(header, columns, kinds=COLUMN_KINDS):
+
+    """ Builds an arrow table from a header and a list of columns, typing
+        each column by name from kinds.
+    """
+
+    pa = import_pyarrow()
+    arrays = [column_array(values, kinds.get(name, 'string'))
+        for name, values in zip(header, columns)]
+    return pa.Table.from_arrays(arrays, names=unique_names(header))
+
+
+def write_parquet(output_filename, header, columns, kinds=COLUMN_KINDS):
+
+    pa = import_pyarrow()
+    pa.parquet.write_table(column_table(header, columns, kinds), output_filename,
+        compression='zstd')
+
+    return
+
+
+class ParquetRowWriter(object):
+
+    """ A parquet counterpart to csv.writer for outputs written row by
+        row. Rows are buffered and written one row group of
+        row_group_rows rows at a time. Call close when done, which closes
+        the file even if writing the last rows fails.
+    """
+
+    def __init__(self, output_filename, header, kinds=COLUMN_KINDS,
+            row_group_rows=100000):
+
+        self.output_filename = output_filename
+        self.header = header
+        self.kinds = kinds
+        self.row_group_rows = row_group_rows
+        self.rows = []
+        self.writer = None
+
+    def writerow(self, row):
+
+        self.rows += [row]
+        if len(self.rows) >= self.row_group_rows:
+            self.flush()
+
+    def writerows(self, rows):
+
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+
+        if not self.rows and self.writer is not None:
+            return
+        pa = import_pyarrow()
+        columns = list(zip(*self.rows)) if self.rows else [[] for x in self.header]
+        table = column_table(self.header, columns, self.kinds)
+        if self.writer is None:
+            self.writer = pa.parquet.ParquetWriter(self.output_filename,
+                table.schema, compression='zstd')
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+
+        try:
+            self.flush()
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+
+
+@contextmanager
+def table_writer(output_filename, header, output_format='csv', kinds=COLUMN_KINDS):
+
+    """ Opens output_filename for writing rows in output_format, writes the
+        header and yields an object with writerow and writerows.
+    """
+
+    if output_format == 'parquet':
+        writer = ParquetRowWriter(output_filename, header, kinds)
+        try:
+            yield writer
+        finally:
+            writer.close()
+    else:
+        with open(output_filename, 'w', newline='') as outfile:
+            writer = csv.writer(outfile, delimiter=',')
+            writer.writerow(header)
+            yield writer
+
+    return
@@ -0,0 +1,153 @@
+import re
+import numpy as np
+
+from datetime import datetime
+from functools import lru_cache
+
+
+# Distinct strings remembered by the strptime fallback, across calls.
+MEMO_SIZE = 65536
+
+MONTH_NAMES = {name: idx + 1 for idx, name in enumerate(['January', 'February',
+    'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October',
+    'November', 'December'])}
+
+# Digits allowed in each numeric directive, and the range of its values.
+DIGIT_FIELDS = {'Y': (4, 4, 1, 9999), 'm': (1, 2, 1, 12), 'd': (1, 2, 1, 31),
+    'H': (1, 2, 0, 23), 'M': (1, 2, 0, 59), 'S': (1, 2, 0, 59), 'f': (1, 6, 0, 999999)}
+
+
+def split_format(date_format):
+
+    """ Splits a strptime format into its directives and the literal text
+        after each, if every directive is one of DIGIT_FIELDS or %B, none
+        repeats and each is followed by literal text or the end of the
+        format. The literal text must not be able to occur within the
+        directive before it, so fields can be split at its first
+        occurrence. Returns None for formats without a fast path.
+    """
+
+    tokens = re.split(r'%(.)', date_format)
+    if tokens[0] or len(tokens) < 3:
+        return None
+    directives = tokens[1::2]
+    literals = tokens[2::2]
+    fields = [x.replace('B', 'm') for x in directives]
+    if any(x not in DIGIT_FIELDS for x in fields) or len(set(fields)) < len(fields) or \
+            any(not x for x in literals[:-1]) or \
+            any('%' in x or re.search(r'\d', x) for x in literals) or \
+            any(re.search(r'[^\W\d]', x) for directive, x in zip(directives, literals)
+                if directive == 'B'):
+        return None
+    return list(zip(directives, literals))
+
+
+def day_numbers(years, months, days):
+
+    """ Returns the days since 1970-01-01 of arrays of calendar dates, and
+        a mask of the dates that do not exist.
+    """
+
+    invalid = (years < 1) | (years > 9999) | (months < 1) | (months > 12) | (days < 1)
+    month_numbers = np.where(invalid, 0, (years - 1970) * 12 + months - 1)
+    month_starts = month_numbers.astype('datetime64[M]').astype('datetime64[D]')
+    next_starts = (month_numbers + 1).astype('datetime64[M]').astype('datetime64[D]')
+    invalid |= days > (next_starts - month_starts).astype(np.int64)
+    return month_starts.astype(np.int64) + days - 1, invalid
+
+
+def parse_fields(texts, fields):
+
+    """ Parses an array of distinct strings with the directives and
+        literals of split_format. Returns seconds since 1970-01-01 and a
+        mask of the strings that were parsed.
+    """
+
+    # strptime matches are case insensitive and allow runs of whitespace
+    # where the format has one space, so anything else goes to strptime.
+    parsed = np.array([x.isascii() for x in texts.tolist()], dtype=bool)
+    values = {'Y': 1900, 'm': 1, 'd': 1, 'H': 0, 'M': 0, 'S': 0}
+    rest = texts
+    for directive, literal in fields:
+        if literal:
+            field, separator, rest = np.strings.partition(rest, literal)
+            parsed &= separator == literal
+        else:
+            field, rest = rest, np.zeros(len(rest), dtype=str)
+        if directive == 'B':
+            value = np.zeros(len(texts), dtype=np.int64)
+            for name, month in MONTH_NAMES.items():
+                value[field == name] = month
+            parsed &= value > 0
+        else:
+            min_digits, max_digits, low, high = DIGIT_FIELDS[directive]
+            lengths = np.strings.str_len(field)
+            parsed &= np.strings.isdecimal(field) & (lengths >= min_digits) & \
+                (lengths <= max_digits)
+            value = np.where(parsed, field, '0').astype(np.int64)
+            parsed &= (value >= low) & (value <= high)
+        # Fractions of a second are dropped, as datetime64[s] drops them.
+        if directive != 'f':
+            values['m' if directive == 'B' else directive] = value
+    parsed &= rest == ''
+
+    days, invalid = day_numbers(*[np.broadcast_to(np.asarray(values[x], dtype=np.int64),
+        len(texts)) for x in 'Ymd'])
+    parsed &= ~invalid
+    seconds = days * 86400 + values['H'] * 3600 + values['M'] * 60 + values['S']
+    return np.where(parsed, seconds, 0), parsed
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def strptime_seconds(date_format, text):
+
+    return date_seconds(datetime.strptime(text, date_format))
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def call_seconds(parse_date, text):
+
+    return date_seconds(parse_date(text))
+
+
+def date_seconds(date):
+
+    return int(np.datetime64(date, 's').astype(np.int64))
+
+
+def to_seconds(dates):
+
+    """ Converts a list or array of dates to integer seconds since 1970-01-01.
+    """
+
+    return np.array(dates, dtype='datetime64[s]').astype(np.int64)
+
+
+def parse_dates(texts, date_format, parse_date=None):
+
+    """ Parses a column of date strings to a datetime64[s] array, parsing
+        each distinct string once. Formats made of the directives in
+        split_format are parsed a whole column at a time, and strings they
+        do not cover, and other formats, go through strptime. parse_date,
+        if given, is called instead of strptime for every string. The last
+        MEMO_SIZE strings sent to strptime or parse_date are remembered
+        across calls, which helps chunked reads.
+    """
+
+    texts = np.asarray(texts, dtype=str)
+    if not len(texts):
+        return np.zeros(0, dtype='datetime64[s]')
+    unique_texts, inverse = np.unique(texts, return_inverse=True)
+
+    fields = split_format(date_format) if parse_date is None else None
+    if fields is None:
+        seconds = np.zeros(len(unique_texts), dtype=np.int64)
+        parsed = np.zeros(len(unique_texts), dtype=bool)
+    else:
+        seconds, parsed = parse_fields(unique_texts, fields)
+    for idx in np.flatnonzero(~parsed).tolist():
+        text = unique_texts[idx].item()
+        seconds[idx] = strptime_seconds(date_format, text) if parse_date is None \
+            else call_seconds(parse_date, text)
+
+    return seconds[inverse.ravel()].astype('datetime64[s]')
@@ -0,0 +1,120 @@
+from datetime import datetime
+
+from campaign_zero.data_preprocessing.dates import parse_dates
+
+
+class Department(object):
+
+    """ Describes how to read one department's spreadsheets. Columns are
+        given as positions or header names, and dates are parsed with the
+        given strptime formats, a whole column at a time by the
+        parse_*_dates methods; override the parse_*_date methods for
+        anything strptime cannot read directly. Assignments ending on
+        open_end_date are still ongoing, and data_retrieval_date stands in
+        for the date the data was pulled. force_types names the flag
+        columns of the use of force spreadsheet's 'force_codes', in order.
+    """
+
+    def __init__(self, name, community_divisions, assignment_columns,
+            allegation_columns, force_columns, filenames=None,
+            assignment_date_format='%Y-%m-%d %H:%M:%S',
+            allegation_date_format='%B %d, %Y', force_date_format='%m/%d/%Y',
+            open_end_date=datetime(3000, 1, 1),
+            data_retrieval_date=datetime(2019, 1, 1), valid_genders=('M', 'F'),
+            gender_codes=None, race_codes=None, citizen_origin='Citizen',
+            force_officer_separator=';', force_types=None):
+
+        self.name = name
+        self.community_divisions = list(community_divisions)
+        self.assignment_columns = dict(assignment_columns)
+        self.allegation_columns = dict(allegation_columns)
+        self.force_columns = dict(force_columns)
+        if filenames is None:
+            filenames = {'assignments': f'{name}_police_assignments.csv',
+                'allegations': f'{name}_allegations.csv',
+                'force': f'{name}_use_of_force.csv'}
+        self.filenames = dict(filenames)
+        self.assignment_date_format = assignment_date_format
+        self.allegation_date_format = allegation_date_format
+        self.force_date_format = force_date_format
+        self.open_end_date = open_end_date
+        self.data_retrieval_date = data_retrieval_date
+        self.valid_genders = list(valid_genders)
+        self.gender_codes = gender_codes if gender_codes is not None else {'F': 0, 'M': 1, ' ': 2}
+        self.race_codes = race_codes if race_codes is not None else \
+            {'A': 0, 'B': 1, 'I': 2, 'T': 3, 'W': 4, 'H': 5, ' ': 6}
+        self.citizen_origin = citizen_origin
+        self.force_officer_separator = force_officer_separator
+        if force_types is None:
+            force_types = [f'force_code_{idx}' for idx in
+                range(len(self.force_columns.get('force_codes', [])))]
+        self.force_types = list(force_types)
+
+    def __repr__(self):
+
+        # Used in parse cache keys, so it must cover every setting.
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            f'{key}={value!r}' for key, value in sorted(vars(self).items())))
+
+    def parse_assignment_date(self, text):
+
+        return datetime.strptime(text, self.assignment_date_format)
+
+    def parse_allegation_date(self, text):
+
+        return datetime.strptime(text, self.allegation_date_format)
+
+    def parse_force_date(self, text):
+
+        return datetime.strptime(text, self.force_date_format)
+
+    def parse_date_column(self, texts, kind):
+
+        """ Parses a column of kind ('assignment', 'allegation' or 'force')
+            dates to a datetime64[s] array, with the fast paths of
+            parse_dates unless parse_{kind}_date is overridden.
+        """
+
+        parse_date = getattr(self, f'parse_{kind}_date')
+        if parse_date.__func__ is getattr(Department, f'parse_{kind}_date'):
+            parse_date = None
+        return parse_dates(texts, getattr(self, f'{kind}_date_format'), parse_date)
+
+    def parse_assignment_dates(self, texts):
+
+        return self.parse_date_column(texts, 'assignment')
+
+    def parse_allegation_dates(self, texts):
+
+        return self.parse_date_column(texts, 'allegation')
+
+    def parse_force_dates(self, texts):
+
+        return self.parse_date_column(texts, 'force')
+
+
+def column_index(header, column):
+
+    """ Returns the position of a column given by position or header name.
+    """
+
+    if isinstance(column, str):
+        return header.index(column)
+    return column
+
+
+# Assignment dates carry milliseconds, e.g. '2013-01-01 00:00:00.000'.
+NASHVILLE = Department('nashville',
+    community_divisions=[x + ' Precinct Division' for x in ['South', 'West',
+        'East', 'North', 'Central', 'Hermitage']] +
+        [x + ' Precinct' for x in ['Madison', 'Mid-Town Hills']],
+    assignment_columns={'emp_id': 0, 'bureau': 1, 'division': 2, 'section': 3,
+        'start_date': -6, 'end_date': -5, 'hire_date': -4, 'race': -3,
+        'gender': -2, 'age': -1},
+    allegation_columns={'control_number': 1, 'date': 2, 'last_name': 3,
+        'first_name': 4, 'emp_id': 6, 'allegation_id': 9, 'origin': 12},
+    force_columns={'incident_num': 0, 'date': 2, 'officers': -5,
+        'force_codes': list(range(3, 14))},
+    assignment_date_format='%Y-%m-%d %H:%M:%S.%f',
+    force_types=['firearm', 'baton', 'k9', 'chemical_spray', 'tear_gas', 'taser',
+        'other_weapon', 'foot', 'hand', 'takedown', 'grapple'])
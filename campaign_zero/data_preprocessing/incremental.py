@@ -0,0 +1,366 @@
+import os
+import re
+import glob
+import hashlib
+import pickle
+import numpy as np
+
+from collections import defaultdict
+from datetime import datetime
+
+from campaign_zero.data_preprocessing.departments import NASHVILLE
+from campaign_zero.data_preprocessing.instrumentation import RunRecorder
+from campaign_zero.data_preprocessing.preprocess import \
+    parse_assignments, parse_allegations, parse_force, load_assignments, \
+    load_allegations, load_force, count_force, derive_rates, \
+    write_department_outputs, force_type_fields
+from campaign_zero.data_preprocessing.tables import AllegationTable
+
+
+# Bump this whenever the layout of the saved state changes.
+STATE_VERSION = 8
+
+# Segments of one kind are merged into one once there are more than this.
+MAX_SEGMENTS = 16
+
+
+def file_signature(input_filename, length=None):
+
+    """ Returns (size, sha256) of the first length bytes of a file, or of
+        the whole file if length is None.
+    """
+
+    size = os.path.getsize(input_filename) if length is None else length
+    content_hash = hashlib.sha256()
+    remaining = size
+    with open(input_filename, 'rb') as openfile:
+        while remaining > 0:
+            chunk = openfile.read(min(1024 ** 2, remaining))
+            if not chunk:
+                break
+            content_hash.update(chunk)
+            remaining -= len(chunk)
+    return size, content_hash.hexdigest()
+
+
+def appended_start_byte(input_filename, signature):
+
+    """ Returns the byte offset of rows appended to a file since it had the
+        given signature, or None if earlier content has changed.
+    """
+
+    size, content_hash = signature
+    if size == 0 or os.path.getsize(input_filename) < size:
+        return None
+    if file_signature(input_filename, size) != signature:
+        return None
+    with open(input_filename, 'rb') as openfile:
+        openfile.seek(size - 1)
+        if openfile.read(1) != b'\n':
+            return None
+    return size
+
+
+def write_segment(state_folder, state, kind, columns, replace=False):
+
+    """ Saves columns of appended rows as the next segment of kind, either
+        'allegations' or 'force', or as its only segment with replace. The
+        segment is only used once save_state has recorded it.
+    """
+
+    segment = f'{kind}_{state["next_segment"]}.npz'
+    np.savez(os.path.join(state_folder, segment), **columns)
+    state['next_segment'] += 1
+    state['segments'][kind] = ([] if replace else state['segments'][kind]) + [segment]
+
+    return
+
+
+def first_free_segment(state_folder):
+
+    """ Returns a segment number above every segment in state_folder, so
+        new segments never overwrite those of the last saved state, or
+        those left behind by an interrupted run.
+    """
+
+    matches = [re.fullmatch(r'(?:allegations|force)_(\d+)\.npz', os.path.basename(x))
+        for x in glob.glob(os.path.join(state_folder, '*.npz'))]
+    numbers = [int(x.group(1)) for x in matches if x]
+    return max(numbers, default=-1) + 1
+
+
+def compact_segments(state_folder, state):
+
+    """ Merges the segments of each kind into one once there are more than
+        MAX_SEGMENTS of them.
+    """
+
+    if len(state['segments']['allegations']) > MAX_SEGMENTS:
+        write_segment(state_folder, state, 'allegations', allegation_columns(
+            state['allegation_table'], list(state['all_control_numbers'])), replace=True)
+    if len(state['segments']['force']) > MAX_SEGMENTS:
+        write_segment(state_folder, state, 'force', force_columns(state['force_dict']),
+            replace=True)
+
+    return
+
+
+def read_segments(state_folder, segments):
+
+    """ Returns the columns of a list of segments, concatenated.
+    """
+
+    loaded = [np.load(os.path.join(state_folder, x)) for x in segments]
+    columns = {key: np.concatenate([x[key] for x in loaded]) for key in loaded[0].files}
+    for segment in loaded:
+        segment.close()
+    return columns
+
+
+def allegation_columns(allegation_table, control_numbers, rows=slice(None)):
+
+    """ Returns the segment columns for some rows of an AllegationTable,
+        along with the control numbers of the input rows behind them.
+    """
+
+    columns = {f'original_{idx}': x[rows] for idx, x in
+        enumerate(allegation_table.original_columns)}
+    columns.update({key: getattr(allegation_table, key)[rows]
+        for key in AllegationTable.COLUMNS})
+    columns['control_numbers'] = np.asarray(control_numbers, dtype=str)
+    return columns
+
+
+def force_columns(force_dict):
+
+    return {'incident_nums': np.array(list(force_dict.keys()), dtype=str),
+        'force_masks': np.array(list(force_dict.values()), dtype=np.int64)}
+
+
+def save_state(state_folder, state):
+
+    """ Pickles the officer level state, along with the segments holding
+        the allegations and force dedup index, then deletes segments that
+        are no longer used. The employee dictionary, built with a lambda
+        factory, is stored as a plain dictionary.
+    """
+
+    saved = {key: state[key] for key in ['version', 'config', 'files', 'header',
+        'officer_table', 'segments', 'next_segment']}
+    saved['employee_dict'] = dict(state['employee_dict'])
+    state_filename = os.path.join(state_folder, 'state.pkl')
+    temp_filename = state_filename + '.tmp'
+    with open(temp_filename, 'wb') as outfile:
+        pickle.dump(saved, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_filename, state_filename)
+
+    segments = set(sum(state['segments'].values(), []))
+    for segment in glob.glob(os.path.join(state_folder, '*.npz')):
+        if os.path.basename(segment) not in segments:
+            os.remove(segment)
+
+    return
+
+
+def load_state(state_folder):
+
+    state_filename = os.path.join(state_folder, 'state.pkl')
+    if not os.path.exists(state_filename):
+        return None
+    with open(state_filename, 'rb') as openfile:
+        state = pickle.load(openfile)
+    if state.get('version') != STATE_VERSION:
+        return None
+
+    employee_dict = defaultdict(lambda: defaultdict(list))
+    employee_dict.update(state['employee_dict'])
+    state['employee_dict'] = employee_dict
+
+    allegations = read_segments(state_folder, state['segments']['allegations'])
+    state['allegation_table'] = AllegationTable(state['header'], state['officer_table'])
+    state['allegation_table'].append([allegations[f'original_{idx}']
+        for idx in range(len(state['header']))],
+        {key: allegations[key] for key in AllegationTable.COLUMNS})
+    state['all_control_numbers'] = set(allegations['control_numbers'].tolist())
+    force = read_segments(state_folder, state['segments']['force'])
+    state['force_dict'] = dict(zip(force['incident_nums'].tolist(),
+        force['force_masks'].tolist()))
+    return state
+
+
+def build_state(state_folder, department, filenames, end_bytes, config):
+
+    """ Runs every loading stage from scratch on the spreadsheets up to
+        end_bytes, keeping what later runs need to continue from where this
+        one stopped.
+    """
+
+    employee_dict, officer_table = load_assignments(parse_assignments(
+        filenames['assignments'], department, end_byte=end_bytes['assignments']), department)
+    all_control_numbers = set()
+    allegation_table = load_allegations(parse_allegations(filenames['allegations'],
+        department, end_byte=end_bytes['allegations']), employee_dict,
+        officer_table, all_control_numbers=all_control_numbers)
+    force_dict = load_force(parse_force(filenames['force'], department,
+        end_byte=end_bytes['force']), employee_dict)
+    count_force(employee_dict, config[2], config[3], force_dict, department.force_types)
+    derive_rates(employee_dict)
+
+    state = {'version': STATE_VERSION, 'config': config,
+        'employee_dict': employee_dict, 'officer_table': officer_table,
+        'allegation_table': allegation_table, 'header': allegation_table.header,
+        'force_dict': force_dict, 'all_control_numbers': all_control_numbers,
+        'segments': {'allegations': [], 'force': []},
+        'next_segment': first_free_segment(state_folder)}
+    write_segment(state_folder, state, 'allegations',
+        allegation_columns(allegation_table, list(all_control_numbers)))
+    write_segment(state_folder, state, 'force', force_columns(force_dict))
+    return state
+
+
+def update_state(state_folder, state, department, filenames, start_bytes, end_bytes):
+
+    """ Folds rows appended to the allegations and use of force spreadsheets
+        between start_bytes and end_bytes into state, saving them as new
+        segments. Returns the IDs of employees whose counts may have
+        changed.
+    """
+
+    employee_dict = state['employee_dict']
+    allegation_table = state['allegation_table']
+
+    allegations = parse_allegations(filenames['allegations'], department,
+        start_bytes['allegations'], end_bytes['allegations'])
+    new_emp_ids = set(allegations['emp_ids'].tolist())
+    previous_names = {emp_id: employee_dict[emp_id]['last_name']
+        for emp_id in new_emp_ids if emp_id in employee_dict}
+    previous_rows = len(allegation_table)
+    load_allegations(allegations, employee_dict, state['officer_table'],
+        allegation_table, state['all_control_numbers'])
+
+    # Rows that reuse an allegation ID change earlier rows in place, so
+    # the allegations are saved again as one segment.
+    if len(allegation_table) - previous_rows == len(np.unique(allegations['allegation_ids'])):
+        if len(allegations['emp_ids']):
+            write_segment(state_folder, state, 'allegations', allegation_columns(
+                allegation_table, allegations['control_numbers'], slice(previous_rows, None)))
+    else:
+        write_segment(state_folder, state, 'allegations', allegation_columns(
+            allegation_table, list(state['all_control_numbers'])), replace=True)
+
+    # A new or changed last name can change how earlier force incidents
+    # resolve, so those are re-attributed from scratch.
+    renamed = [emp_id for emp_id in new_emp_ids if not employee_dict[emp_id]['missing']
+        and employee_dict[emp_id]['last_name'] != previous_names.get(emp_id)]
+    if renamed:
+        for emp_id, item in employee_dict.items():
+            item['force_times'] = []
+            item['force_incidents'] = []
+        state['force_dict'] = load_force(parse_force(filenames['force'], department,
+            end_byte=end_bytes['force']), employee_dict)
+        write_segment(state_folder, state, 'force', force_columns(state['force_dict']),
+            replace=True)
+    else:
+        force = parse_force(filenames['force'], department, start_bytes['force'],
+            end_bytes['force'])
+        load_force(force, employee_dict, state['force_dict'])
+        if len(force['incident_nums']):
+            write_segment(state_folder, state, 'force', force_columns({incident_num:
+                state['force_dict'][incident_num]
+                for incident_num in force['incident_nums'].tolist()}))
+    compact_segments(state_folder, state)
+
+    force_fields = ['force_count'] + force_type_fields(department.force_types)
+    previous_force_counts = {emp_id: [item[x] for x in force_fields]
+        for emp_id, item in employee_dict.items()}
+    count_force(employee_dict, state['config'][2], state['config'][3],
+        state['force_dict'], department.force_types)
+    affected = new_emp_ids | set(emp_id for emp_id, item in employee_dict.items()
+        if [item[x] for x in force_fields] != previous_force_counts.get(emp_id))
+    derive_rates(employee_dict, affected)
+
+    return affected
+
+
+def preprocess_department_incremental(department, input_data_folder,
+        output_data_folder, state_folder, period_length=180,
+        period_start_date=datetime(2009, 1, 1), period_end_date=datetime(2018, 7, 18),
+        output_format='csv', panel_features=False, recorder=None):
+
+    """ Same outputs as preprocess_department, but keeps its state in
+        state_folder between runs. The allegations and force dedup index
+        are saved as segments, and each run only adds segments for the rows
+        appended since. When the allegations and use of force spreadsheets
+        have only had rows appended, and the assignments, department and
+        period settings are unchanged, only the new rows are processed and
+        only the affected employees' rates are recomputed. Anything else
+        triggers a full rebuild. Outputs are still rewritten in full, as new
+        allegations change the employee columns of earlier rows. The
+        manifest is written last. Returns the affected employee IDs, or
+        None after a full rebuild.
+    """
+
+    if recorder is None:
+        recorder = RunRecorder()
+    recorder.settings.update({'department': department.name,
+        'period_length': period_length, 'period_start_date': period_start_date,
+        'period_end_date': period_end_date, 'state_folder': state_folder,
+        'output_format': output_format, 'panel_features': panel_features})
+    filenames = {key: os.path.join(input_data_folder, filename)
+        for key, filename in department.filenames.items()}
+    for key, filename in filenames.items():
+        recorder.add_input(key, filename)
+    config = (repr(department), period_length, period_start_date, period_end_date)
+    os.makedirs(state_folder, exist_ok=True)
+
+    # Signatures are taken before anything is parsed, and only the bytes
+    # they cover are parsed, so rows appended during the run are left for
+    # the next one.
+    files = {key: file_signature(filename) for key, filename in filenames.items()}
+    end_bytes = {key: size for key, (size, content_hash) in files.items()}
+
+    with recorder.stage('load_state'):
+        start_bytes = None
+        state = load_state(state_folder)
+        if state is not None and state['config'] == config and \
+                files['assignments'] == state['files']['assignments']:
+            start_bytes = {key: appended_start_byte(filenames[key], state['files'][key])
+                for key in ['allegations', 'force']}
+            if None in start_bytes.values():
+                start_bytes = None
+
+    if start_bytes is None:
+        with recorder.stage('build_state') as stage:
+            state = build_state(state_folder, department, filenames, end_bytes, config)
+            stage['rows_out'] = len(state['allegation_table'])
+        affected = None
+    else:
+        with recorder.stage('update_state') as stage:
+            affected = update_state(state_folder, state, department, filenames,
+                start_bytes, end_bytes)
+            stage['rows_out'] = len(affected)
+    recorder.count(full_rebuild=affected is None,
+        affected_employees=None if affected is None else len(affected))
+
+    write_department_outputs(recorder, department, output_data_folder,
+        state['employee_dict'], state['officer_table'], state['allegation_table'],
+        period_length, period_start_date, period_end_date, output_format, panel_features)
+
+    with recorder.stage('save_state'):
+        state['files'] = files
+        save_state(state_folder, state)
+
+    recorder.write_manifest(os.path.join(output_data_folder,
+        f'{department.name}_run_manifest.json'))
+
+    return affected
+
+
+def preprocess_nashville_incremental(input_data_folder, output_data_folder,
+        state_folder, period_length=180, period_start_date=datetime(2009, 1, 1),
+        period_end_date=datetime(2018, 7, 18), output_format='csv',
+        panel_features=False, recorder=None):
+
+    return preprocess_department_incremental(NASHVILLE, input_data_folder,
+        output_data_folder, state_folder, period_length, period_start_date,
+        period_end_date, output_format, panel_features, recorder)
@@ -0,0 +1,138 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import tracemalloc
+
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Bump this whenever the layout of the manifest changes.
+MANIFEST_VERSION = 1
+
+
+def peak_rss_bytes():
+
+    """ Returns the peak resident set size of this process so far, or None
+        where the resource module is unavailable.
+    """
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def json_default(value):
+
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+class RunRecorder(object):
+
+    """ Records the stages of a preprocessing run, each with its wall time,
+        rows in and out and the process's peak RSS when it finished, along
+        with named counts of what each filter dropped. profile may be
+        'cprofile', which adds the slowest functions of each stage, or
+        'tracemalloc', which adds each stage's peak traced allocation.
+        Both slow the run down.
+    """
+
+    def __init__(self, profile=None):
+
+        if profile not in [None, 'cprofile', 'tracemalloc']:
+            raise ValueError(f'Unknown profile {profile!r}')
+        self.profile = profile
+        self.stages = []
+        self.counts = {}
+        self.settings = {}
+        self.inputs = {}
+        self.outputs = {}
+        self.started = datetime.now()
+
+    @contextmanager
+    def stage(self, name, rows_in=None):
+
+        """ Times the enclosed block. Yields the stage's record, so the block
+            can fill in rows_out.
+        """
+
+        record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+        if self.profile == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        elif self.profile == 'tracemalloc':
+            tracing = tracemalloc.is_tracing()
+            if not tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            start_bytes = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            if self.profile == 'cprofile':
+                profiler.disable()
+                stats = pstats.Stats(profiler)
+                slowest = sorted(stats.stats.items(), key=lambda x: -x[1][3])[:10]
+                record['slowest_functions'] = [{'function': '{}:{}({})'.format(*key),
+                    'cumulative_seconds': value[3]} for key, value in slowest]
+            elif self.profile == 'tracemalloc':
+                record['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1] - start_bytes
+                if not tracing:
+                    tracemalloc.stop()
+            record['peak_rss_bytes'] = peak_rss_bytes()
+            self.stages += [record]
+
+    def count(self, **counts):
+
+        self.counts.update(counts)
+
+    def add_input(self, key, filename):
+
+        self.inputs[key] = {'filename': filename, 'bytes': os.path.getsize(filename)}
+
+    def add_output(self, key, filename, rows=None):
+
+        self.outputs[key] = {'filename': filename, 'rows': rows}
+
+    def manifest(self):
+
+        return {
+            'version': MANIFEST_VERSION,
+            'started': self.started,
+            'seconds': sum(x['seconds'] for x in self.stages),
+            'peak_rss_bytes': peak_rss_bytes(),
+            'python': sys.version.split()[0],
+            'settings': self.settings,
+            'inputs': self.inputs,
+            'outputs': self.outputs,
+            'stages': self.stages,
+            'counts': self.counts}
+
+    def write_manifest(self, output_filename):
+
+        """ Writes the manifest through a temporary file, so readers watching
+            output_filename never see it half written.
+        """
+
+        temp_filename = output_filename + '.tmp'
+        with open(temp_filename, 'w') as outfile:
+            json.dump(self.manifest(), outfile, indent=2, default=json_default)
+        os.replace(temp_filename, output_filename)
+
+        return
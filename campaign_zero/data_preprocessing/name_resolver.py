@@ -0,0 +1,77 @@
+from bisect import bisect_left
+from collections import defaultdict
+
+from campaign_zero.data_preprocessing.dates import date_seconds
+
+
+MATCH = 'match'
+AMBIGUOUS = 'ambiguous'
+OUT_OF_RANGE = 'out_of_range'
+MISSING = 'missing'
+
+
+class NameResolver(object):
+
+    """ Resolves officer last names, as written in incident reports, to
+        employee IDs. Employees are indexed by upper-case last name. Each
+        name's timeline is cut at every candidate's start and end date into
+        segments, each holding the candidates active throughout it, so a
+        lookup is a dictionary hit plus a binary search. Times are seconds
+        since 1970-01-01.
+    """
+
+    def __init__(self, employee_dict):
+
+        index = defaultdict(list)
+        for emp_id, item in employee_dict.items():
+            last_name = item['last_name']
+            if not isinstance(last_name, str) or item['missing']:
+                continue
+            index[last_name] += [(date_seconds(item['start_date']),
+                date_seconds(item['end_date']), emp_id)]
+
+        self.candidates = {}
+        self.boundaries = {}
+        self.segments = {}
+        for last_name, candidates in index.items():
+            candidates = sorted(candidates, key=lambda x: x[0])
+            self.candidates[last_name] = [x[2] for x in candidates]
+
+            # Candidates join at (start, 0) and leave at (end, 1), so they
+            # are still active at their end time.
+            events = sorted([(start, 0, idx) for idx, (start, end, emp_id) in
+                enumerate(candidates) if start <= end] +
+                [(end, 1, idx) for idx, (start, end, emp_id) in
+                enumerate(candidates) if start <= end])
+            active = set()
+            segments = [()]
+            for time, leaving, idx in events:
+                if leaving:
+                    active.discard(idx)
+                else:
+                    active.add(idx)
+                segments += [tuple(candidates[x][2] for x in sorted(active))]
+            self.boundaries[last_name] = [x[:2] for x in events]
+            self.segments[last_name] = segments
+
+    def resolve(self, last_name, time):
+
+        """ Returns (emp_ids, reason). emp_ids holds every employee with
+            this last name active at time, or every employee with this last
+            name if none were active. reason is one of MATCH, AMBIGUOUS,
+            OUT_OF_RANGE or MISSING.
+        """
+
+        last_name = last_name.upper()
+        if last_name not in self.candidates:
+            return [], MISSING
+
+        emp_ids = self.segments[last_name][
+            bisect_left(self.boundaries[last_name], (time, 1))]
+
+        if len(emp_ids) == 1:
+            return list(emp_ids), MATCH
+        elif len(emp_ids) > 1:
+            return list(emp_ids), AMBIGUOUS
+        else:
+            return list(self.candidates[last_name]), OUT_OF_RANGE
@@ -0,0 +1,383 @@
+import csv
+import numpy as np
+
+from datetime import datetime
+
+from campaign_zero.data_preprocessing.columnar import MODEL_COLUMN_KINDS, write_parquet
+from campaign_zero.data_preprocessing.dates import date_seconds, to_seconds
+from campaign_zero.data_preprocessing.tables import SECONDS_PER_DAY, group_keys
+
+
+GENDER_CODES = {'F': 0, 'M': 1, ' ': 2}
+RACE_CODES = {'A': 0, 'B': 1, 'I': 2, 'T': 3, 'W': 4, 'H': 5, ' ': 6}
+MODEL_HEADER = ['police_id', 'time_period', 'division', 'allegations',
+    'race', 'gender', 'age', 'experience', 'full_name', 'force_count']
+LAG_HEADER = ['allegations_lag1', 'prior_allegations', 'force_lag1', 'prior_force']
+
+
+def group_ranges(starts, lengths):
+
+    """ Concatenates range(start, start + length) for each pair, as one array.
+    """
+
+    total = int(lengths.sum())
+    group_offsets = np.cumsum(lengths) - lengths
+    return np.arange(total) - np.repeat(group_offsets - starts, lengths)
+
+
+def feature_header(num_divisions, force_types=()):
+
+    """ Returns the extra model spreadsheet columns written with
+        panel_features, for a department with num_divisions community
+        divisions and the given force_types.
+    """
+
+    return ['switch', 'exposure_days'] + \
+        [f'division_{code}_days' for code in range(num_divisions)] + LAG_HEADER + \
+        [f'{force_type}_force_count' for force_type in force_types]
+
+
+def cumulative_time(keys, starts, ends, query_keys, query_times):
+
+    """ For intervals [starts, ends) labelled with integer keys, returns
+        the time each query key's intervals cover before each query time,
+        counting overlaps once. Interval starts and ends are sorted once as
+        +1 and -1 events, so the number of open intervals and the time
+        covered are running sums, and each query is a binary search into
+        them.
+    """
+
+    if not len(keys):
+        return np.zeros(len(query_keys))
+    ends = np.maximum(ends, starts)
+    times = np.concatenate([starts, ends])
+    event_keys = np.concatenate([keys, keys])
+    deltas = np.concatenate([np.ones(len(keys), np.int64), -np.ones(len(keys), np.int64)])
+    composite, query_composite = group_keys(event_keys, times, query_keys, query_times)
+    order = np.argsort(composite, kind='stable')
+    composite, times = composite[order], times[order]
+
+    # Every key's events sum to zero, so nothing is open between keys, and
+    # a key's coverage is the running total less its total at the key's
+    # first event.
+    open_intervals = np.minimum(np.cumsum(deltas[order]), 1)
+    covered = np.concatenate([[0], np.cumsum(open_intervals[:-1] * np.diff(times))])
+
+    positions = np.searchsorted(composite, query_composite, side='right') - 1
+    firsts = np.searchsorted(event_keys[order], query_keys, side='left')
+    matched = positions >= firsts
+    positions = positions[matched]
+    result = np.zeros(len(query_keys))
+    result[matched] = covered[positions] - covered[firsts[matched]] + \
+        open_intervals[positions] * (query_times[matched] - times[positions])
+    return result
+
+
+def counts_by_period(owners, seconds, num_officers, period_seconds, last_period):
+
+    """ Counts events by officer and period, for periods 0 to last_period,
+        with everything before period 0 counted in a leading column.
+        Returns an (officers, last_period + 2) array.
+    """
+
+    width = last_period + 2
+    buckets = np.maximum(seconds // period_seconds, -1) + 1
+    keep = buckets < width
+    return np.bincount(owners[keep] * width + buckets[keep],
+        minlength=num_officers * width).reshape(num_officers, width)
+
+
+def count_by_key(panel_keys, keys):
+
+    """ Counts how many of keys land on each entry of the sorted panel_keys.
+    """
+
+    positions = np.searchsorted(panel_keys, keys)
+    matched = positions < len(panel_keys)
+    matched[matched] = panel_keys[positions[matched]] == keys[matched]
+    return np.bincount(positions[matched], minlength=len(panel_keys))
+
+
+def usable_emp_ids(officer_table):
+
+    """ Returns the IDs of officers without assignment errors, in table order.
+    """
+
+    return [emp_id for emp_id, x in zip(officer_table.emp_ids, ~officer_table.errors) if x]
+
+
+def flatten_allegations(allegation_table, officer_codes, community_divisions, stats=None):
+
+    """ Returns (owners, times, citizen) arrays for the allegations in an
+        AllegationTable that count towards the panel. owners are codes from
+        officer_codes and times are seconds since 1970-01-01. If stats is given,
+        the allegations dropped by each filter are added to it.
+    """
+
+    owners = np.array([officer_codes.get(x, -1) for x in allegation_table.emp_ids.tolist()],
+        dtype=np.int64)
+    usable = owners >= 0
+    duplicate = usable & allegation_table.duplicate_control
+    community = usable & ~duplicate & allegation_table.in_divisions(community_divisions)
+    dropped = {'unusable_officer': int((~usable).sum()),
+        'duplicate_control': int(duplicate.sum()),
+        'non_community_division': int((usable & ~duplicate & ~community).sum())}
+
+    if stats is not None:
+        for key, value in dropped.items():
+            stats[f'allegations_{key}'] = stats.get(f'allegations_{key}', 0) + value
+
+    return owners[community], allegation_table.times[community], \
+        allegation_table.citizen[community]
+
+
+def index_officers(officer_table, allegation_table, community_divisions,
+        flat_allegations=None, stats=None):
+
+    """ Selects the assignment histories of every usable officer from
+        officer_table, and flattens their allegations into arrays, with
+        dates as seconds since 1970-01-01. This does not depend on the time
+        period configuration, so it can be shared between calls to
+        build_model_panel. Allegations already flattened against
+        usable_emp_ids may be passed as flat_allegations instead of
+        allegation_table. If stats is given, the officers and allegations
+        left out are counted into it.
+    """
+
+    division_dict = {x: i for i, x in enumerate(community_divisions)}
+
+    usable = ~officer_table.errors
+    emp_ids = usable_emp_ids(officer_table)
+    offsets = officer_table.offsets
+    lengths = (offsets[1:] - offsets[:-1])[usable]
+    rows = np.repeat(usable, offsets[1:] - offsets[:-1])
+    firsts = offsets[:-1][usable]
+    lasts = offsets[1:][usable] - 1
+    community_codes = np.array([division_dict.get(x, -1)
+        for x in officer_table.divisions.categories], dtype=np.int64)
+    owners = np.repeat(np.arange(len(emp_ids)), lengths)
+    switch_rows = officer_table.switch[rows]
+    if stats is not None:
+        stats['officers_with_errors'] = int((~usable).sum())
+
+    if flat_allegations is None:
+        officer_codes = {emp_id: code for code, emp_id in enumerate(emp_ids)}
+        flat_allegations = flatten_allegations(allegation_table, officer_codes,
+            division_dict, stats)
+    allegation_owners, allegation_times, citizen = flat_allegations
+
+    return {
+        'emp_ids': emp_ids,
+        'lengths': lengths,
+        'offsets': np.concatenate([[0], np.cumsum(lengths)]),
+        'starts': to_seconds(officer_table.start_dates[rows]),
+        'ends': to_seconds(officer_table.end_dates[rows]),
+        'division_codes': community_codes[officer_table.divisions.codes[rows]],
+        'ages': officer_table.ages[rows].astype(np.int64),
+        'experiences': officer_table.experiences[rows].astype(np.int64),
+        'first_starts': to_seconds(officer_table.start_dates[firsts]),
+        'last_ends': to_seconds(officer_table.end_dates[lasts]),
+        'switch_owners': owners[switch_rows],
+        'switch_times': to_seconds(officer_table.start_dates[rows][switch_rows]),
+        'allegation_owners': allegation_owners,
+        'allegation_times': allegation_times,
+        'citizen': citizen}
+
+
+def build_model_panel(employee_dict, officer_table, allegation_table, community_divisions,
+        period_length=180, period_start_date=datetime(2009, 1, 1),
+        period_end_date=datetime(2018, 7, 18), officer_index=None,
+        race_codes=RACE_CODES, gender_codes=GENDER_CODES, stats=None, force_types=()):
+
+    """ Builds the officer x time period panel behind the model formatted
+        spreadsheets. Each period takes the division, age and experience of
+        the assignment active when the period starts, and counts the
+        non-duplicate allegations made while the officer was on a community
+        division. Returns a dictionary of columns, including a boolean
+        'switch' column for periods in which the officer switched division.
+        Each period also gets the days assigned to each community division
+        ('division_{code}_days') and their sum ('exposure_days'), which
+        makes switch periods usable with an exposure offset, and the
+        allegations and force of the previous period ('_lag1') and of all
+        earlier time ('prior_'), including time before period_start_date.
+        The officer's force counts by each of force_types, as set by
+        count_force, are copied into '{force_type}_force_count' columns.
+        officer_index may be passed in from index_officers to skip
+        re-flattening the inputs, and race_codes and gender_codes map the
+        officer columns to the integers written out. If stats is given, the
+        periods and allegations dropped at each step are counted into it.
+    """
+
+    if stats is None:
+        stats = {}
+    if officer_index is None:
+        officer_index = index_officers(officer_table, allegation_table,
+            community_divisions, stats=stats)
+
+    emp_ids = officer_index['emp_ids']
+    num_divisions = len(community_divisions)
+    if not emp_ids:
+        return {key: [] for key in MODEL_HEADER + feature_header(num_divisions, force_types) +
+            ['civilian_allegations', 'civilian_allegations_lag1',
+                'prior_civilian_allegations']}
+
+    period_seconds = period_length * SECONDS_PER_DAY
+    last_period = (period_end_date - period_start_date).days // period_length
+    origin = date_seconds(period_start_date)
+    offsets = officer_index['offsets']
+    division_codes = officer_index['division_codes']
+
+    # Periods between each officer's first start and last end date.
+    first_periods = (officer_index['first_starts'] - origin) // period_seconds
+    last_periods = (officer_index['last_ends'] - origin) // period_seconds
+    first_periods = np.maximum(first_periods, 1)
+    last_periods = np.minimum(last_periods - 1, last_period)
+    period_counts = np.maximum(last_periods - first_periods + 1, 0)
+    owners = np.repeat(np.arange(len(emp_ids)), period_counts)
+    time_periods = group_ranges(first_periods, period_counts)
+
+    # Find the first assignment starting after each period start. Start
+    # dates are made non-decreasing within each officer with a running
+    # maximum over the grouped keys, which leaves that first index
+    # unchanged, so one sorted search covers every officer.
+    starts = officer_index['starts'] - origin
+    assignment_owners = np.repeat(np.arange(len(emp_ids)), officer_index['lengths'])
+    keys, period_keys = group_keys(assignment_owners, starts, owners,
+        time_periods * period_seconds)
+    next_assignments = np.searchsorted(np.maximum.accumulate(keys), period_keys, side='right')
+    found = next_assignments < offsets[owners + 1]
+    active = np.maximum(next_assignments - 1, offsets[owners])
+
+    keep = found & (division_codes[active] >= 0)
+    stats['periods_in_service'] = len(found)
+    stats['periods_without_later_assignment'] = int((~found).sum())
+    stats['periods_non_community_division'] = int((found & ~keep).sum())
+    owners = owners[keep]
+    time_periods = time_periods[keep]
+    active = active[keep]
+
+    # Flag periods containing a division switch.
+    panel_keys = owners * (last_period + 1) + time_periods
+    switch_periods = (officer_index['switch_times'] - origin) // period_seconds
+    switch_keys = officer_index['switch_owners'] * (last_period + 1) + switch_periods
+    switch_keys = switch_keys[(switch_periods >= 1) & (switch_periods <= last_period)]
+    switch = np.isin(panel_keys, switch_keys)
+
+    # Count allegations into their officer's period.
+    allegation_seconds = officer_index['allegation_times'] - origin
+    in_range = (allegation_seconds >= 0) & (allegation_seconds <=
+        int((period_end_date - period_start_date).total_seconds()))
+    allegation_keys = officer_index['allegation_owners'] * (last_period + 1) + \
+        allegation_seconds // period_seconds
+    allegations = count_by_key(panel_keys, allegation_keys[in_range])
+    civilian_allegations = count_by_key(panel_keys,
+        allegation_keys[in_range & officer_index['citizen']])
+    stats['switch_periods'] = int(switch.sum())
+    stats['allegations_out_of_time_range'] = int((~in_range).sum())
+    stats['allegations_outside_panel_periods'] = int(in_range.sum() - allegations.sum())
+
+    # Days on each community division in each period, as the difference of
+    # the officer's running assignment time on it at the period's ends.
+    # Assignments can overlap, so exposure_days is the time on any
+    # community division rather than the sum over divisions.
+    # End dates are inclusive, as in days_assigned, so each assignment
+    # covers up to the end of its last day.
+    community = division_codes >= 0
+    assignment_starts = starts[community]
+    assignment_ends = (officer_index['ends'] - origin + SECONDS_PER_DAY)[community]
+    period_begins = time_periods * period_seconds
+
+    def days_assigned(assignment_keys, query_keys, begins):
+        covered = cumulative_time(assignment_keys, assignment_starts, assignment_ends,
+            np.concatenate([query_keys, query_keys]),
+            np.concatenate([begins + period_seconds, begins]))
+        return (covered[:len(begins)] - covered[len(begins):]) / SECONDS_PER_DAY
+
+    division_days = days_assigned(
+        assignment_owners[community] * num_divisions + division_codes[community],
+        (owners[:, None] * num_divisions + np.arange(num_divisions)).ravel(),
+        np.repeat(period_begins, num_divisions)).reshape(len(owners), num_divisions)
+    exposure_days = days_assigned(assignment_owners[community], owners, period_begins)
+
+    # Lagged and prior counts, from each officer's counts by period. Force
+    # is counted over the same window as force_count.
+    window = allegation_seconds <= int((period_end_date - period_start_date).total_seconds())
+    force_times = [employee_dict[emp_id]['force_times'] for emp_id in emp_ids]
+    force_owners = np.repeat(np.arange(len(emp_ids)), [len(x) for x in force_times])
+    force_seconds = np.array([x for times in force_times for x in times],
+        dtype=np.int64) - origin
+    force_window = force_seconds <= int((period_end_date - period_start_date).total_seconds())
+    lagged = {}
+    for key, event_owners, event_seconds in [
+            ('allegations', officer_index['allegation_owners'][window], allegation_seconds[window]),
+            ('civilian_allegations', officer_index['allegation_owners'][window & officer_index['citizen']],
+                allegation_seconds[window & officer_index['citizen']]),
+            ('force', force_owners[force_window], force_seconds[force_window])]:
+        counts = counts_by_period(event_owners, event_seconds, len(emp_ids),
+            period_seconds, last_period)
+        lagged[f'{key}_lag1'] = counts[owners, time_periods].tolist()
+        lagged[f'prior_{key}'] = (np.cumsum(counts, axis=1) - counts)[owners,
+            time_periods + 1].tolist()
+
+    # Officer level columns.
+    officers = owners.tolist()
+    race = {}
+    gender = {}
+    for owner in set(officers):
+        item = employee_dict[emp_ids[owner]]
+        race[owner] = race_codes[item['race']]
+        gender[owner] = gender_codes[item['gender']]
+
+    return {
+        'police_id': [emp_ids[x] for x in officers],
+        'time_period': time_periods.tolist(),
+        'division': division_codes[active].tolist(),
+        'allegations': allegations.tolist(),
+        'civilian_allegations': civilian_allegations.tolist(),
+        'race': [race[x] for x in officers],
+        'gender': [gender[x] for x in officers],
+        'age': officer_index['ages'][active].tolist(),
+        'experience': officer_index['experiences'][active].tolist(),
+        'full_name': [employee_dict[emp_ids[x]]['full_name'] for x in officers],
+        'force_count': [employee_dict[emp_ids[x]]['force_count'] for x in officers],
+        **{f'{x}_force_count': [employee_dict[emp_ids[owner]][f'{x}_force_count']
+            for owner in officers] for x in force_types},
+        'switch': switch.tolist(),
+        'exposure_days': exposure_days.tolist(),
+        **{f'division_{code}_days': division_days[:, code].tolist()
+            for code in range(num_divisions)},
+        **lagged}
+
+
+def write_model_panel(output_filename, panel, allegation_column='allegations',
+        output_format='csv', header=MODEL_HEADER):
+
+    """ Writes the non-switch periods of a panel from build_model_panel,
+        returning how many were written. allegation_column selects which
+        count fills the 'allegations' column, and its lags. output_format
+        'parquet' writes the panel's columns straight to a typed parquet
+        file. header may add columns from feature_header, and if it
+        includes 'switch', switch periods are kept and flagged instead.
+    """
+
+    columns = [x.replace('allegations', allegation_column)
+        if x.replace('allegations', allegation_column) in panel else x for x in header]
+    if 'switch' in header:
+        kept = list(range(len(panel['switch'])))
+    else:
+        kept = np.flatnonzero(~np.asarray(panel['switch'], dtype=bool)).tolist()
+
+    if output_format == 'parquet':
+        kinds = dict(MODEL_COLUMN_KINDS, **{x: 'float' for x in header if x.endswith('_days')},
+            **{x: 'int' for x in header if x.endswith('_force_count')})
+        write_parquet(output_filename, header,
+            [[panel[column][idx] for idx in kept] for column in columns], kinds)
+        return len(kept)
+
+    with open(output_filename, 'w', newline='') as outfile:
+        writer = csv.writer(outfile, delimiter=',')
+        writer.writerow(header)
+        for idx in kept:
+            writer.writerow([panel[column][idx] for column in columns])
+
+    return len(kept)
@@ -0,0 +1,102 @@
+import os
+import csv
+
+from concurrent.futures import ProcessPoolExecutor
+
+from campaign_zero.data_preprocessing.columnar import import_pyarrow, output_filename
+from campaign_zero.data_preprocessing.preprocess import preprocess_department
+from campaign_zero.data_preprocessing.streaming import preprocess_department_streaming
+
+
+def combine_model_panels(combined_filename, department_filenames, output_format='csv'):
+
+    """ Concatenates per department model formatted spreadsheets into one,
+        with a leading department column. department_filenames is a list of
+        (department name, filename) pairs.
+    """
+
+    if output_format == 'parquet':
+        combine_model_parquet(combined_filename, department_filenames)
+        return
+
+    with open(combined_filename, 'w', newline='') as outfile:
+        writer = csv.writer(outfile, delimiter=',')
+        header = None
+        for name, filename in department_filenames:
+            with open(filename, 'r') as openfile:
+                reader = csv.reader(openfile, delimiter=',')
+                department_header = next(reader)
+                if header is None:
+                    header = department_header
+                    writer.writerow(['department'] + header)
+                elif department_header != header:
+                    raise ValueError(f'{filename} does not match the model header {header}')
+                for row in reader:
+                    writer.writerow([name] + row)
+
+    return
+
+
+def combine_model_parquet(combined_filename, department_filenames):
+
+    pa = import_pyarrow()
+    header = None
+    tables = []
+    for name, filename in department_filenames:
+        table = pa.parquet.read_table(filename)
+        if header is None:
+            header = table.schema.names
+        elif table.schema.names != header:
+            raise ValueError(f'{filename} does not match the model header {header}')
+        department = pa.array([name] * table.num_rows, pa.string()).dictionary_encode()
+        tables += [table.add_column(0, 'department', department)]
+    pa.parquet.write_table(pa.concat_tables(tables), combined_filename,
+        compression='zstd')
+
+    return
+
+
+def preprocess_departments(jobs, output_data_folder, processes=None,
+        chunk_rows=None, output_format='csv', **kwargs):
+
+    """ Preprocesses several departments in parallel. jobs is a list of
+        (department, input data folder) pairs. Each department's outputs
+        are written to a subfolder of output_data_folder named after it,
+        and the model formatted spreadsheets are also combined across
+        departments. processes defaults to the number of CPUs. If
+        chunk_rows is given, departments are streamed with
+        preprocess_department_streaming. Any other keyword arguments are
+        passed on to the preprocessing function.
+    """
+
+    kwargs['output_format'] = output_format
+
+    preprocess = preprocess_department
+    if chunk_rows is not None:
+        preprocess = preprocess_department_streaming
+        kwargs['chunk_rows'] = chunk_rows
+
+    names = [department.name for department, input_data_folder in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError(f'Department names must be unique, got {names}')
+
+    output_folders = [os.path.join(output_data_folder, name) for name in names]
+    for output_folder in output_folders:
+        os.makedirs(output_folder, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(preprocess, department,
+            input_data_folder, output_folder, **kwargs)
+            for (department, input_data_folder), output_folder in zip(jobs, output_folders)]
+        for future in futures:
+            future.result()
+
+    for suffix in ['', '_citizen']:
+        combine_model_panels(os.path.join(output_data_folder,
+            output_filename(f'combined_model_formatted{suffix}', output_format)),
+            [(name, os.path.join(output_folder,
+                output_filename(f'{name}_model_formatted{suffix}', output_format)))
+                for name, output_folder in zip(names, output_folders)],
+            output_format)
+
+    return
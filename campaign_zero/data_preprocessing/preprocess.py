@@ -2,243 +2,413 @@ import os
 import glob
 import csv
 import sys
-import math
-# import numpy as np
+import numpy as np
+
+from itertools import islice
 
 from collections import defaultdict
-from datetime import datetime, timedelta
+from datetime import datetime
 from pprint import pprint
 
+from campaign_zero.analysis.shrinkage import fit_shrinkage, write_shrinkage_results
+from campaign_zero.data_preprocessing.cache import ParseCache
+from campaign_zero.data_preprocessing.columnar import output_filename, table_writer, \
+    COLUMN_KINDS
+from campaign_zero.data_preprocessing.dates import date_seconds
+from campaign_zero.data_preprocessing.departments import NASHVILLE, column_index
+from campaign_zero.data_preprocessing.instrumentation import RunRecorder
+from campaign_zero.data_preprocessing.name_resolver import NameResolver, MATCH
+from campaign_zero.data_preprocessing.tables import OfficerTable, AllegationTable, \
+    MISSING_OFFICER
+from campaign_zero.data_preprocessing.panel import build_model_panel, \
+    index_officers, write_model_panel, feature_header, MODEL_HEADER
+
+
+COMMUNITY_DIVISIONS = NASHVILLE.community_divisions
+
+
+def mapped_positions(header, columns):
+
+    """ Returns the positions of the columns named in a Department column
+        mapping, counted from the start of header.
+    """
+
+    header = list(header)
+    positions = set()
+    for column in columns.values():
+        for x in column if isinstance(column, list) else [column]:
+            positions.add(column_index(header, x) % len(header))
+    return positions
+
+
+def column_arrays(reader, header, columns=None, chunk_rows=100000):
+
+    """ Yields the rows of a csv.reader chunk_rows rows at a time as a list
+        of one array of strings per column, each only as wide as its
+        longest value. If columns is given, as a Department column mapping,
+        the columns it does not name are None.
+    """
+
+    positions = set(range(len(header))) if columns is None else \
+        mapped_positions(header, columns)
+    while True:
+        rows = list(islice(reader, chunk_rows))
+        if not rows:
+            break
+        for row in rows:
+            if len(row) != len(header):
+                raise ValueError(f'Expected {len(header)} columns, got {len(row)}: {row}')
+        values = list(zip(*rows))
+        del rows
+        yield [np.array(values[idx], dtype=str) if idx in positions else None
+            for idx in range(len(header))]
+
+
+def bounded_lines(openfile, end_byte):
+
+    """ Yields the decoded lines of a binary file up to byte offset end_byte.
+    """
+
+    while openfile.tell() < end_byte:
+        line = openfile.readline()
+        if not line:
+            break
+        yield line.decode()
+
+
+def read_csv(input_filename, start_byte=0, columns=None, end_byte=None):
+
+    """ Returns the header and columns of a spreadsheet, with each column
+        as its own array of strings, only as wide as its longest value. If
+        columns is given, as a Department column mapping, the columns it
+        does not name are None. If start_byte is given, only rows from that
+        byte offset onwards are read, and if end_byte is given, only rows
+        before it.
+    """
+
+    with open(input_filename, 'r' if end_byte is None else 'rb') as openfile:
+        reader = csv.reader(openfile if end_byte is None else
+            bounded_lines(openfile, end_byte), delimiter=',')
+        header = next(reader)
+        if start_byte:
+            openfile.seek(start_byte)
+        chunks = list(column_arrays(reader, header, columns))
+    positions = set(range(len(header))) if columns is None else \
+        mapped_positions(header, columns)
+    return np.array(header), [(np.concatenate([chunk[idx] for chunk in chunks])
+        if chunks else np.zeros(0, dtype=str)) if idx in positions else None
+        for idx in range(len(header))]
+
+
+def read_csv_chunks(input_filename, chunk_rows=100000, columns=None):
+
+    """ Yields the header and columns of a spreadsheet chunk_rows rows at a
+        time, in the same form as read_csv.
+    """
+
+    with open(input_filename, 'r') as openfile:
+        reader = csv.reader(openfile, delimiter=',')
+        header = next(reader)
+        for chunk in column_arrays(reader, header, columns, chunk_rows):
+            yield np.array(header), chunk
+
+
+def select_columns(header, columns, mapping):
+
+    """ Returns a dictionary of the columns named in a Department column
+        mapping, from the columns of read_csv. Fields mapped to a list of
+        columns get a list of arrays.
+    """
+
+    header = header.tolist()
+    selected = {}
+    for field, column in mapping.items():
+        if isinstance(column, list):
+            selected[field] = [columns[column_index(header, x)] for x in column]
+        else:
+            selected[field] = columns[column_index(header, column)]
+    return selected
+
+
+def original_columns(allegations):
+
+    """ Returns the columns of the allegations spreadsheet kept by
+        parse_allegation_rows, in order.
+    """
+
+    return [allegations[f'original_{idx}'] for idx in range(len(allegations['header']))]
+
+
+def parse_assignments(assigments_filename, department=NASHVILLE, start_byte=0,
+        end_byte=None):
+
+    """ Parses the assignments spreadsheet into typed columns.
+    """
+
+    header, columns = read_csv(assigments_filename, start_byte,
+        department.assignment_columns, end_byte)
+    columns = select_columns(header, columns, department.assignment_columns)
+    end_dates = department.parse_assignment_dates(columns['end_date'])
+    return {'emp_ids': columns['emp_id'], 'bureaus': columns['bureau'],
+        'divisions': columns['division'], 'sections': columns['section'],
+        'races': columns['race'], 'genders': columns['gender'],
+        'ages': columns['age'].astype(np.int64),
+        'hire_dates': department.parse_assignment_dates(columns['hire_date']),
+        'start_dates': department.parse_assignment_dates(columns['start_date']),
+        'end_dates': end_dates,
+        'open_ended': end_dates == np.datetime64(department.open_end_date, 's')}
+
+
+def parse_allegations(allegations_filename, department=NASHVILLE, start_byte=0,
+        end_byte=None):
+
+    """ Parses the allegations spreadsheet into typed columns, keeping the
+        original columns, as 'original_{position}', for the extended
+        allegations spreadsheet.
+    """
+
+    header, columns = read_csv(allegations_filename, start_byte, end_byte=end_byte)
+    return parse_allegation_rows(header, columns, department)
+
+
+def parse_allegation_rows(header, columns, department=NASHVILLE):
+
+    original = {f'original_{idx}': column for idx, column in enumerate(columns)}
+    columns = select_columns(header, columns, department.allegation_columns)
+    return {'header': header, **original,
+        'emp_ids': columns['emp_id'], 'allegation_ids': columns['allegation_id'],
+        'control_numbers': columns['control_number'],
+        'first_names': columns['first_name'], 'last_names': columns['last_name'],
+        'origins': columns['origin'],
+        'citizen': columns['origin'] == department.citizen_origin,
+        'dates': department.parse_allegation_dates(columns['date'])}
 
-def preprocess_nashville(input_data_folder, output_data_folder, 
-        period_length=180, period_start_date=datetime(2009, 1, 1),
-        period_end_date=datetime(2018, 7, 18),
-        only_unique_control_nums=True):
-
-    force_filename = os.path.join(input_data_folder, 'nashville_use_of_force.csv')
-    assigments_filename = os.path.join(input_data_folder, 'nashville_police_assignments.csv')
-    allegations_filename = os.path.join(input_data_folder, 'nashville_allegations.csv')
-    
-    # Built-In Variables
-    community_divisions = [x + ' Precinct Division' for x in ['South', 'West', 'East', 'North',
-        'Central', 'Hermitage']] + \
-        [x + ' Precinct' for x in ['Madison', 'Mid-Town Hills']]
-    all_time_periods = range(int(math.floor((period_end_date - period_start_date).days / period_length)))
-    time_period_starts = [timedelta(180 * x) + period_start_date for x in all_time_periods]
+
+def parse_force(force_filename, department=NASHVILLE, start_byte=0, end_byte=None):
+
+    """ Parses the use of force spreadsheet into typed columns. The officers
+        involved in each incident are stored separated by semicolons, and
+        the force code flags packed into one integer per row, with bit i
+        set for the department's i-th force type.
+    """
+
+    header, columns = read_csv(force_filename, start_byte, department.force_columns,
+        end_byte)
+    return parse_force_rows(header, columns, department)
+
+
+def parse_force_rows(header, columns, department=NASHVILLE):
+
+    columns = select_columns(header, columns, department.force_columns)
+    separator = department.force_officer_separator
+    force_masks = np.zeros(len(columns['incident_num']), dtype=np.int64)
+    for bit, flags in enumerate(columns.get('force_codes', [])):
+        flags = np.char.strip(flags.astype(str))
+        force_masks |= ((flags != '0') & (flags != '')).astype(np.int64) << bit
+    return {'incident_nums': columns['incident_num'],
+        'force_masks': force_masks,
+        'officers': np.array([';'.join(x.strip() for x in officers.split(separator))
+            for officers in columns['officers']], dtype=str),
+        'dates': department.parse_force_dates(columns['date'])}
+
+
+def parse_department(department, input_data_folder, cache_folder=None):
+
+    """ Parses a department's assignments, allegations and use of force
+        spreadsheets. If cache_folder is given, parsed columns are cached
+        there and reused while the input files are unchanged.
+    """
+
+    parsers = [('assignments', parse_assignments),
+        ('allegations', parse_allegations), ('force', parse_force)]
+    filenames = [os.path.join(input_data_folder, department.filenames[key])
+        for key, parser in parsers]
+
+    if cache_folder is None:
+        return [parser(filename, department)
+            for filename, (key, parser) in zip(filenames, parsers)]
+
+    cache = ParseCache(cache_folder)
+    return [cache.parse(filename, parser, department)
+        for filename, (key, parser) in zip(filenames, parsers)]
+
+
+def load_assignments(assignments, department=NASHVILLE):
+
+    """ Builds an OfficerTable of assignment histories from the parsed
+        assignments, and a dictionary of per employee fields.
+    """
+
+    officer_table = OfficerTable(assignments, department)
 
     # Extract employee and assingment information
     employee_dict = defaultdict(lambda: defaultdict(list))
-    with open(assigments_filename, 'r') as openfile:
-        reader = csv.reader(openfile, delimiter=',')
+    for code, emp_id in enumerate(officer_table.emp_ids):
+        employee_dict[emp_id]['missing'] = False
 
-        # Skip Header
-        next(reader)
+        # Initailize Complaint Counts
+        employee_dict[emp_id]['force_count'] = 0
+        employee_dict[emp_id]['allegation_count'] = 0
+        employee_dict[emp_id]['civilian_allegation_count'] = 0
+        employee_dict[emp_id]['allegation_count_assignment'] = 0
+        employee_dict[emp_id]['civilian_allegation_count_assignment'] = 0
 
-        for row in reader:
-            emp_id = row[0]
+        # Variables which require the whole employment history.
+        employee_dict[emp_id].update(officer_table.officer_fields(code))
 
-            # Variables to be used later.
-            employee_dict[emp_id]['error'] = False
-            employee_dict[emp_id]['missing'] = False
+    return employee_dict, officer_table
 
-            # Initailize Complaint Counts
-            employee_dict[emp_id]['force_count'] = 0
-            employee_dict[emp_id]['allegation_count'] = 0
-            employee_dict[emp_id]['civilian_allegation_count'] = 0
-            employee_dict[emp_id]['allegation_count_assignment'] = 0
-            employee_dict[emp_id]['civilian_allegation_count_assignment'] = 0
-            
-            # Demographic Variables
-            employee_dict[emp_id]['gender'] = row[-2]
-            if row[-2] not in ['M', 'F']:
-                employee_dict[emp_id]['error'] = True
-            employee_dict[emp_id]['race'] = row[-3]
-            
-            # Assignment Variables
-            employee_dict[emp_id]['bureaus'] += [row[1]]
-            employee_dict[emp_id]['divisions'] += [row[2]]
-            employee_dict[emp_id]['sections'] += [row[3]]
-            
-            # Age Variables
-            employee_dict[emp_id]['ages'] += [int(row[-1])]
-            if int(row[-1]) > 100:
-                employee_dict[emp_id]['error'] = True
-            if 'max_age' not in employee_dict[emp_id].keys():
-                employee_dict[emp_id]['max_age'] = int(row[-1])
-            else:
-                employee_dict[emp_id]['max_age'] = max(int(row[-1]), employee_dict[emp_id]['max_age'])
-
-            # Assignment Duration Variables
-            employee_dict[emp_id]['hire_date'] = datetime.strptime(row[-4][:-4], '%Y-%m-%d %H:%M:%S')
-            employee_dict[emp_id]['start_dates'] += [datetime.strptime(row[-6][:-4], '%Y-%m-%d %H:%M:%S')]            
-            end_date = row[-5][:-4]
-            if end_date == '3000-01-01 00:00:00':
-                # Adjust this to time data was retrieved.
-                # employee_dict[emp_id]['end_dates'] += [datetime.today()]
-                if len(employee_dict[emp_id]['end_dates']) == 0:
-                    employee_dict[emp_id]['end_dates'] += [datetime(2019, 1, 1)]
-                    employee_dict[emp_id]['error'] = True
-                else:
-                    employee_dict[emp_id]['end_dates'] += [employee_dict[emp_id]['end_dates'][-1]]
-            else:
-                employee_dict[emp_id]['end_dates'] += [datetime.strptime(row[-5][:-4], '%Y-%m-%d %H:%M:%S')]
-
-            # Experience Variables
-            employee_dict[emp_id]['experiences'] += [(employee_dict[emp_id]['start_dates'][-1] - employee_dict[emp_id]['hire_date']).days]
-            employee_dict[emp_id]['max_experience'] = (datetime(2019, 1, 1) - employee_dict[emp_id]['hire_date']).days
-            
-    # Employee variables which require the whole employment history.
-    for emp_id, item in employee_dict.items():
-        start_date = item['start_dates'][0]
-        end_date = item['end_dates'][-1]
-        employee_dict[emp_id]['start_date'] = start_date
-        employee_dict[emp_id]['end_date'] = end_date
-        employee_dict[emp_id]['days_assigned'] = (end_date - start_date).days + 1
-
-        # Defining assignment switches.
-        switches = 0
-        community_switches = 0
-        for idx, section in enumerate(item['sections']):
-            division = item['divisions'][idx]
-            if idx == 0:
-                current_section = section
-                current_division = division
-            else:
-                if division != current_division:
-                    if division in community_divisions and current_division in community_divisions:
-                        community_switches += 1
-                        employee_dict[emp_id]['community_switch_dates'] += [employee_dict[emp_id]['start_dates'][idx]]
-                    switches += 1
-                    employee_dict[emp_id]['switch_dates'] += [employee_dict[emp_id]['start_dates'][idx]]
-                current_section = section
-                current_division = division
-        employee_dict[emp_id]['switches'] = switches
-        employee_dict[emp_id]['community_switches'] = community_switches
-
-        # Note: we can't truly know who is active, because 
-        # end dates are not well defined.
-        employee_dict[emp_id]['active'] = end_date.date() >= datetime(2019, 1, 1).date()
+
+def load_allegations(allegations, employee_dict, officer_table,
+        allegation_table=None, all_control_numbers=None, update_employees=True):
+
+    """ Builds an AllegationTable of parsed allegations, matching each to the
+        assignment active on its date and updating employee counts. Pass
+        the allegation_table and all_control_numbers of an earlier call to
+        continue it with rows appended since. With update_employees False,
+        employee names and counts are left as they are.
+    """
 
     # Extract allegation information
-    all_control_numbers = []
-    allegation_dict = defaultdict(lambda: defaultdict(int))
-    with open(allegations_filename, 'r') as openfile:
-        reader = csv.reader(openfile, delimiter=',')
-        original_header = next(reader)
-
-        for row in reader:
-            emp_id = row[6]
-            allegation_id = row[9]
-            allegation_dict[allegation_id]['emp_id'] = emp_id
-            allegation_dict[allegation_id]['original_data'] = row
-            allegation_dict[allegation_id]['allegation_origin'] = row[12]
-            control_number = row[1]
-            allegation_dict[allegation_id]['control_number'] = control_number
-            if control_number in all_control_numbers:
-                allegation_dict[allegation_id]['duplicate_control'] = True
-            else:
-                allegation_dict[allegation_id]['duplicate_control'] = False
-            allegation_dict[allegation_id]['control_number'] = control_number
-            all_control_numbers += [control_number]
-
-            employee_dict[emp_id]['first_name'] = row[4].upper()
-            employee_dict[emp_id]['last_name'] = row[3].upper()
-            employee_dict[emp_id]['full_name'] = row[4] + ' ' + row[3]
-            allegation_dict[allegation_id]['gender'] = employee_dict[emp_id]['gender']
-            allegation_dict[allegation_id]['race'] = employee_dict[emp_id]['race']
-            date = datetime.strptime(row[2], '%B %d, %Y')
-            allegation_dict[allegation_id]['date'] = date
-
-            previous_end_date = datetime(1900, 1, 1)
-            time_fields = ['bureau', 'division', 'section', 'age', 'experience']
-            for date_index, end_date in enumerate(employee_dict[emp_id]['end_dates']):
-                if date_index == 0 and date < end_date:
-                    for field in time_fields:
-                        allegation_dict[allegation_id][field] = 'Unassigned'
-                    allegation_dict[allegation_id]['during_assignment'] = False
-                    break
-                if date <= end_date and date > previous_end_date:
-                    for field in time_fields:
-                        allegation_dict[allegation_id][field] = employee_dict[emp_id][field + 's'][date_index]
-                    allegation_dict[allegation_id]['during_assignment'] = True
-                    break
-                if date_index == len(employee_dict[emp_id]['end_dates']) - 1:
-                    for field in time_fields:
-                        allegation_dict[allegation_id][field] = employee_dict[emp_id][field + 's'][-1]
-                    allegation_dict[allegation_id]['during_assignment'] = False
-                    break
-                previous_end_date = end_date
-
-            for key in ['bureau', 'division', 'section']:
-                if key not in allegation_dict[allegation_id].keys():
-                    allegation_dict[allegation_id][key] = ''
-
-            if 'allegation_count' not in employee_dict[emp_id]:
-                employee_dict[emp_id]['civilian_allegation_count'] = 1
-                employee_dict[emp_id]['allegation_count'] = 1
-                employee_dict[emp_id]['civilian_allegation_count_assignment'] = 1
-                employee_dict[emp_id]['allegation_count_assignment'] = 1
+    if all_control_numbers is None:
+        all_control_numbers = set()
+    if allegation_table is None:
+        allegation_table = AllegationTable(allegations['header'].tolist(), officer_table)
+    duplicate_control = []
+    for control_number in allegations['control_numbers'].tolist():
+        duplicate_control += [control_number in all_control_numbers]
+        all_control_numbers.add(control_number)
+    emp_ids = allegations['emp_ids']
+    citizen = allegations['citizen'].astype(bool)
+    times = allegations['dates'].astype(np.int64)
+    assignment_rows, during_assignment = officer_table.find_assignments(emp_ids, times)
+    allegation_table.append(original_columns(allegations), {
+        'allegation_ids': allegations['allegation_ids'], 'emp_ids': emp_ids,
+        'times': times, 'citizen': citizen,
+        'duplicate_control': np.array(duplicate_control, dtype=bool),
+        'assignment_rows': assignment_rows, 'during_assignment': during_assignment})
+    if not update_employees or not len(emp_ids):
+        return allegation_table
+
+    # Names come from each employee's latest row, and counts from all of them.
+    unique_ids, firsts, inverse = np.unique(emp_ids, return_index=True, return_inverse=True)
+    inverse = inverse.ravel()
+    latest = np.zeros(len(unique_ids), dtype=np.int64)
+    latest[inverse] = np.arange(len(inverse))
+    flags = {'allegation_count': np.ones(len(inverse), dtype=bool),
+        'civilian_allegation_count': citizen,
+        'allegation_count_assignment': during_assignment,
+        'civilian_allegation_count_assignment': citizen & during_assignment}
+    totals = {key: np.bincount(inverse, x, len(unique_ids)).astype(np.int64).tolist()
+        for key, x in flags.items()}
+    first_names = allegations['first_names']
+    last_names = allegations['last_names']
+    unique_ids = unique_ids.tolist()
+    for code in np.argsort(firsts, kind='stable').tolist():
+        emp_id = unique_ids[code]
+        first_name, last_name = first_names[latest[code]].item(), last_names[latest[code]].item()
+        employee_dict[emp_id]['first_name'] = first_name.upper()
+        employee_dict[emp_id]['last_name'] = last_name.upper()
+        employee_dict[emp_id]['full_name'] = first_name + ' ' + last_name
+        if 'allegation_count' not in employee_dict[emp_id]:
+            # Employees without assignments start every count at one on
+            # their first allegation, and are named on their second.
+            first = firsts[code]
+            for key, x in flags.items():
+                employee_dict[emp_id][key] = totals[key][code] - int(x[first]) + 1
+            if totals['allegation_count'][code] == 1:
                 employee_dict[emp_id]['full_name'] = 'NA'
-                employee_dict[emp_id]['force_count'] = 0
-                employee_dict[emp_id]['missing'] = True
-            else:
-                if row[-4] == 'Citizen':
-                    employee_dict[emp_id]['civilian_allegation_count'] += 1
-                    if allegation_dict[allegation_id]['during_assignment']:
-                        employee_dict[emp_id]['civilian_allegation_count_assignment'] += 1
-                employee_dict[emp_id]['allegation_count'] += 1
-                if allegation_dict[allegation_id]['during_assignment']:
-                    employee_dict[emp_id]['allegation_count_assignment'] += 1
+            employee_dict[emp_id]['force_count'] = 0
+            employee_dict[emp_id]['missing'] = True
+        else:
+            for key in flags:
+                employee_dict[emp_id][key] += totals[key][code]
+
+    return allegation_table
+
+
+def load_force(force, employee_dict, force_dict=None, name_resolver=None, stats=None):
+
+    """ Attributes parsed force incidents to employees, recording the time,
+        in seconds since 1970-01-01, and number of each incident on the one
+        employee it resolves to, from its first row. Returns force_dict,
+        the dedup index, which maps each incident number to its force
+        codes, packed as by parse_force and merged across the incident's
+        rows. Pass the force_dict of an earlier call to continue it with
+        rows appended since, and a NameResolver to reuse one built from the
+        current employee_dict. If stats is given, rows of incidents already
+        seen and the names resolved for each reason are counted into it.
+    """
 
     # Employee Force Data, Not Yet Completed, could have errors.
-    force_dict = {}
-    all_incident_nums = []
-    all_force_codes = []
-    id_list = [emp_id for emp_id in employee_dict]
-    last_name_list = [employee_dict[emp_id]['last_name'] for emp_id in id_list]
-    with open(force_filename, 'r') as openfile:
-        reader = csv.reader(openfile, delimiter=',')
-        next(reader)
-
-        for row in reader:
-            incident_num = row[0]
-            force_codes = row[3:15]
-            incident_date = datetime.strptime(row[2], '%m/%d/%Y')
-            cops_involved = str.split(row[-5], ';')
-            cops_involved = [x.strip() for x in cops_involved] 
-            force_dict[incident_num] = {}
-            force_dict[incident_num]['cops_involved'] = cops_involved
-            force_dict[incident_num]['incident_date'] = incident_date
-
-            if incident_date < period_start_date or incident_date > period_end_date:
-                force_dict[incident_num]['out_of_time_range'] = True
-            else:
-                force_dict[incident_num]['out_of_time_range'] = False
-
-            # In future analyses, combine force codes across duplicates
-            if incident_num in all_incident_nums:
-                force_dict[incident_num]['duplicate'] = True
-            else:
-                force_dict[incident_num]['duplicate'] = False
-                all_incident_nums += [incident_num, force_codes]
-
-            for last_name in cops_involved:
-                last_name_indexes = [i for i, val in enumerate(last_name_list) if val == last_name]
-                force_emp_ids = [id_list[idx] for idx in last_name_indexes]
-                true_force_emp_ids = []
-                for emp_id in force_emp_ids:
-                    if employee_dict[emp_id]['missing']:
-                        continue
-                    if incident_date < employee_dict[emp_id]['start_date'] or incident_date > employee_dict[emp_id]['end_date']:
-                        continue
-                    else:
-                        true_force_emp_ids += [emp_id]
-                if len(true_force_emp_ids) == 1 and not force_dict[incident_num]['duplicate'] and not force_dict[incident_num]['out_of_time_range']:
-                    employee_dict[emp_id]['force_count'] += 1
+    if force_dict is None:
+        force_dict = {}
+    if stats is None:
+        stats = {}
+    if name_resolver is None:
+        name_resolver = NameResolver(employee_dict)
+    incident_nums = force['incident_nums'].tolist()
+    force_masks = force['force_masks'].tolist()
+    officers = force['officers'].tolist()
+    incident_times = force['dates'].astype(np.int64).tolist()
+    for idx, incident_num in enumerate(incident_nums):
+
+        # Combine force codes across duplicates
+        if incident_num in force_dict:
+            force_dict[incident_num] |= force_masks[idx]
+            stats['duplicate_force_rows'] = stats.get('duplicate_force_rows', 0) + 1
+            continue
+        force_dict[incident_num] = force_masks[idx]
+
+        incident_time = incident_times[idx]
+        cops_involved = [x.strip() for x in officers[idx].split(';')]
+        for last_name in cops_involved:
+            force_emp_ids, reason = name_resolver.resolve(last_name, incident_time)
+            stats[f'force_officers_{reason}'] = stats.get(f'force_officers_{reason}', 0) + 1
+            if reason == MATCH:
+                employee_dict[force_emp_ids[0]]['force_times'] += [incident_time]
+                employee_dict[force_emp_ids[0]]['force_incidents'] += [incident_num]
+
+    return force_dict
+
+
+def force_type_fields(force_types):
+
+    return [f'{force_type}_force_count' for force_type in force_types]
+
+
+def count_force(employee_dict, period_start_date=datetime(2009, 1, 1),
+        period_end_date=datetime(2018, 7, 18), force_dict=None, force_types=()):
+
+    """ Sets each employee's force_count to their incidents in the given
+        range. If force_dict is given, also counts those incidents by each
+        of force_types, into the fields named by force_type_fields.
+    """
+
+    fields = force_type_fields(force_types) if force_dict is not None else []
+    start, end = date_seconds(period_start_date), date_seconds(period_end_date)
+    for emp_id, item in employee_dict.items():
+        in_range = [incident_num for incident_num, x in
+            zip(item['force_incidents'], item['force_times']) if x >= start and x <= end]
+        item['force_count'] = len(in_range)
+        masks = [force_dict[x] for x in in_range] if fields else []
+        for bit, field in enumerate(fields):
+            item[field] = sum((mask >> bit) & 1 for mask in masks)
+
+    return
+
+
+def derive_rates(employee_dict, emp_ids=None):
+
+    """ Adds per day and per year rates for each employee's counts, or
+        only for the employees in emp_ids if given.
+    """
 
     # Derived Statistics
     copy_employee_dict = employee_dict.copy()
     for key, item in copy_employee_dict.items():
+        if emp_ids is not None and key not in emp_ids:
+            continue
         if employee_dict[key]['missing']:
             for field in ['allegation_per_day', 'civilian_allegation_per_day',
                     'civilian_allegation_per_year', 'allegation_per_year',
@@ -256,165 +426,283 @@ def preprocess_nashville(input_data_folder, output_data_folder,
                 employee_dict[key][f'{metric}_per_year'] = employee_dict[key][f'{metric}_per_day'] * 365
     del(copy_employee_dict)
 
+    return
+
+
+EXTENDED_ALLEGATION_FIELDS = ['duplicate_control', 'age', 'gender', 'race', 'bureau', 
+    'division', 'section', 'experience', 'during_assignment',]
+EXTENDED_EMPLOYEE_FIELDS = ['missing', 'days_assigned', 'force_count',
+    'allegation_count_assignment', 
+    'civilian_allegation_count_assignment',
+    'allegation_assignment_per_day', 'allegation_assignment_per_year',
+    'civilian_allegation_assignment_per_day',
+    'civilian_allegation_assignment_per_year',
+    'allegation_count', 
+    'civilian_allegation_count', 'allegation_per_day', 
+    'allegation_per_year', 'civilian_allegation_per_day', 
+    'civlian_allegation_per_year', 'during_assignment']
+
+
+def extended_allegation_rows(allegation_table, employee_dict, chunk_rows=10000):
+
+    """ Yields the rows of the extended allegations spreadsheet, building
+        chunk_rows of them at a time.
+    """
+
+    for start in range(0, len(allegation_table), chunk_rows):
+        rows = slice(start, start + chunk_rows)
+        emp_ids = allegation_table.emp_ids[rows].tolist()
+        fields = {key: allegation_table.assignment_values(key, rows) for key in
+            ['age', 'bureau', 'division', 'section', 'experience']}
+        fields['duplicate_control'] = allegation_table.duplicate_control[rows].tolist()
+        fields['gender'] = [employee_dict[x]['gender'] for x in emp_ids]
+        fields['race'] = [employee_dict[x]['race'] for x in emp_ids]
+        fields['during_assignment'] = [0 if row == MISSING_OFFICER else during for row, during in
+            zip(allegation_table.assignment_rows[rows].tolist(),
+                allegation_table.during_assignment[rows].tolist())]
+        columns = [x[rows].tolist() for x in allegation_table.original_columns] + \
+            [fields[key] for key in EXTENDED_ALLEGATION_FIELDS]
+        for emp_id, output_row in zip(emp_ids, zip(*columns)):
+            yield list(output_row) + [employee_dict[emp_id][key] for key in EXTENDED_EMPLOYEE_FIELDS]
+
+
+def write_allegations_extended(output_data_folder, allegation_table,
+        employee_dict, department=NASHVILLE, output_format='csv'):
+
+    """ Writes the allegations spreadsheet extended with assignment and employee data.
+    """
+
     # Create extended allegations
-    allegations_plus = os.path.join(output_data_folder, 
-        'nashville_allegations_extended.csv')
-    with open(allegations_plus, 'w', newline='') as outfile:
-        writer = csv.writer(outfile, delimiter=',')
-        allegation_header = ['duplicate_control', 'age', 'gender', 'race', 'bureau', 
-            'division', 'section', 'experience', 'during_assignment',]
-        employee_header = ['missing', 'days_assigned', 'force_count',
-            'allegation_count_assignment', 
-            'civilian_allegation_count_assignment',
-            'allegation_assignment_per_day', 'allegation_assignment_per_year',
-            'civilian_allegation_assignment_per_day',
-            'civilian_allegation_assignment_per_year',
-            'allegation_count', 
-            'civilian_allegation_count', 'allegation_per_day', 
-            'allegation_per_year', 'civilian_allegation_per_day', 
-            'civlian_allegation_per_year', 'during_assignment']
-        header = original_header + allegation_header + employee_header
-        writer.writerow(header)
-
-        for allegation_id, item in allegation_dict.items():
-            emp_id = item['emp_id']
-            output_row = item['original_data']
-            output_row += [item[key] for key in allegation_header]
-            output_row += [employee_dict[emp_id][key] for key in employee_header]
-            writer.writerow(output_row)
+    allegations_plus = os.path.join(output_data_folder, output_filename(
+        f'{department.name}_allegations_extended', output_format))
+    header = allegation_table.header + EXTENDED_ALLEGATION_FIELDS + EXTENDED_EMPLOYEE_FIELDS
+    with table_writer(allegations_plus, header, output_format) as writer:
+        writer.writerows(extended_allegation_rows(allegation_table, employee_dict))
+
+    return
 
-    # Create cop spreadsheet
-    cop_list = os.path.join(output_data_folder, 
-        'nashville_cop_details.csv')
-
-    with open(cop_list, 'w', newline='') as outfile:
-        writer = csv.writer(outfile, delimiter=',')
-        header = ['emp_id', 'name', 'first_name', 'last_name', 'max_age',
-            'gender', 'race', 'missing',
-            'start_date', 'end_date', 'hire_date', 'max_experience', 
-            'days_assigned', 'switches', 'switches_per_day',
-            'switches_per_year', 
-            'community_switches', 'community_switches_per_day',
-            'community_switches_per_year', 'force_count',
-            'allegation_count_assignment', 
-            'civilian_allegation_count_assignment',
-            'allegation_count_assignment_per_day', 
-            'allegation_count_assignment_per_year',
-            'civilian_allegation_count_assignment_per_day',
-            'civilian_allegation_count_assignment_per_year',
-            'allegation_count',
-            'civilian_allegation_count', 'allegation_count_per_day', 
-            'allegation_count_per_year',
-            'civilian_allegation_count_per_day', 
-            'civilian_allegation_count_per_year']
-        writer.writerow(header)
 
+def write_cop_details(output_data_folder, employee_dict, department=NASHVILLE,
+        output_format='csv'):
+
+    """ Writes one row of details per employee.
+    """
+
+    # Create cop spreadsheet
+    cop_list = os.path.join(output_data_folder, output_filename(
+        f'{department.name}_cop_details', output_format))
+
+    header = ['emp_id', 'name', 'first_name', 'last_name', 'max_age',
+        'gender', 'race', 'missing',
+        'start_date', 'end_date', 'hire_date', 'max_experience', 
+        'days_assigned', 'switches', 'switches_per_day',
+        'switches_per_year', 
+        'community_switches', 'community_switches_per_day',
+        'community_switches_per_year', 'force_count',
+        'allegation_count_assignment', 
+        'civilian_allegation_count_assignment',
+        'allegation_count_assignment_per_day', 
+        'allegation_count_assignment_per_year',
+        'civilian_allegation_count_assignment_per_day',
+        'civilian_allegation_count_assignment_per_year',
+        'allegation_count',
+        'civilian_allegation_count', 'allegation_count_per_day', 
+        'allegation_count_per_year',
+        'civilian_allegation_count_per_day', 
+        'civilian_allegation_count_per_year'] + \
+        force_type_fields(department.force_types)
+    kinds = dict(COLUMN_KINDS, **{x: 'int' for x in force_type_fields(department.force_types)})
+
+    with table_writer(cop_list, header, output_format, kinds) as writer:
         for emp_id, item in employee_dict.items():
             output_row = [emp_id]
             for field in header[1:]:
                 output_row += [item[field]]
             writer.writerow(output_row)
 
+    return
+
+
+def write_department_outputs(recorder, department, output_data_folder, employee_dict,
+        officer_table, allegation_table, period_length=180,
+        period_start_date=datetime(2009, 1, 1), period_end_date=datetime(2018, 7, 18),
+        output_format='csv', panel_features=False):
+
+    """ Writes the extended allegations, cop details and model formatted
+        spreadsheets of a loaded department, recording their stages and
+        files in recorder. Returns the model panel and its number of rows.
+    """
+
+    community_divisions = department.community_divisions
+    with recorder.stage('write_details', len(allegation_table)) as stage:
+        write_allegations_extended(output_data_folder, allegation_table,
+            employee_dict, department, output_format)
+        write_cop_details(output_data_folder, employee_dict, department, output_format)
+        stage['rows_out'] = len(allegation_table) + len(employee_dict)
+    recorder.add_output('allegations_extended', os.path.join(output_data_folder,
+        output_filename(f'{department.name}_allegations_extended', output_format)),
+        len(allegation_table))
+    recorder.add_output('cop_details', os.path.join(output_data_folder,
+        output_filename(f'{department.name}_cop_details', output_format)),
+        len(employee_dict))
+
     # Create model spreadsheet.
     model_spreadsheet = os.path.join(output_data_folder,
-        'nashville_model_formatted.csv')
+        output_filename(f'{department.name}_model_formatted', output_format))
     model_spreadsheet_citizen = os.path.join(output_data_folder,
-        'nashville_model_formatted_citizen.csv')
+        output_filename(f'{department.name}_model_formatted_citizen', output_format))
     model_spreadsheet_citizen_sustained = os.path.join(output_data_folder,
-        'nashville_model_formatted_citizen_sustained.csv')
+        output_filename(f'{department.name}_model_formatted_citizen_sustained',
+            output_format))
+
+    panel_stats = {}
+    with recorder.stage('build_model_panel', len(allegation_table)) as stage:
+        panel = build_model_panel(employee_dict, officer_table, allegation_table,
+            community_divisions, period_length, period_start_date, period_end_date,
+            race_codes=department.race_codes, gender_codes=department.gender_codes,
+            stats=panel_stats, force_types=department.force_types)
+        stage['rows_out'] = len(panel['switch'])
+    recorder.count(**panel_stats)
+    with recorder.stage('write_model_panel', len(panel['switch'])) as stage:
+        header = MODEL_HEADER + feature_header(len(community_divisions),
+            department.force_types) if panel_features else MODEL_HEADER
+        rows = write_model_panel(model_spreadsheet, panel, output_format=output_format,
+            header=header)
+        write_model_panel(model_spreadsheet_citizen, panel, 'civilian_allegations',
+            output_format, header)
+        stage['rows_out'] = rows
+    recorder.add_output('model_formatted', model_spreadsheet, rows)
+    recorder.add_output('model_formatted_citizen', model_spreadsheet_citizen, rows)
+
+    return panel, rows
+
+
+def preprocess_department(department, input_data_folder, output_data_folder,
+        period_length=180, period_start_date=datetime(2009, 1, 1),
+        period_end_date=datetime(2018, 7, 18),
+        only_unique_control_nums=True, cache_folder=None, recorder=None,
+        fit_model=False, output_format='csv', panel_features=False):
+
+    """ Writes the extended allegations, cop details and model formatted
+        spreadsheets for one department, prefixed with its name, and a JSON
+        manifest of the run's stages, row counts and filters alongside
+        them. Pass a RunRecorder to profile the stages. With fit_model, the
+        random intercept model is fit to the citizen allegations panel and
+        its results spreadsheets written too. output_format 'parquet'
+        writes typed, compressed parquet files instead of the spreadsheets,
+        which requires pyarrow. With panel_features, the model spreadsheets
+        keep switch periods and add the exposure and lagged count columns
+        of feature_header. Returns the manifest.
+    """
+
+    if recorder is None:
+        recorder = RunRecorder()
+    recorder.settings.update({'department': department.name,
+        'period_length': period_length, 'period_start_date': period_start_date,
+        'period_end_date': period_end_date, 'cache_folder': cache_folder,
+        'output_format': output_format, 'panel_features': panel_features})
+    for key, filename in department.filenames.items():
+        recorder.add_input(key, os.path.join(input_data_folder, filename))
+
+    with recorder.stage('parse') as stage:
+        assignments, allegations, force = parse_department(department,
+            input_data_folder, cache_folder)
+        stage['rows_out'] = sum(len(x[key]) for x, key in [(assignments, 'emp_ids'),
+            (allegations, 'emp_ids'), (force, 'incident_nums')])
+    with recorder.stage('load_assignments', len(assignments['emp_ids'])) as stage:
+        employee_dict, officer_table = load_assignments(assignments, department)
+        stage['rows_out'] = len(officer_table)
+    with recorder.stage('load_allegations', len(allegations['emp_ids'])) as stage:
+        allegation_table = load_allegations(allegations, employee_dict, officer_table)
+        stage['rows_out'] = len(allegation_table)
+    recorder.count(
+        missing_officers=sum(1 for x in employee_dict.values() if x['missing']),
+        allegations_missing_officer=int(np.sum(
+            allegation_table.assignment_rows == MISSING_OFFICER)),
+        duplicate_control=int(allegation_table.duplicate_control.sum()))
+    force_stats = {}
+    with recorder.stage('load_force', len(force['incident_nums'])) as stage:
+        force_dict = load_force(force, employee_dict, stats=force_stats)
+        stage['rows_out'] = len(force_dict)
+    recorder.count(**force_stats)
+    with recorder.stage('derive_rates', len(employee_dict)) as stage:
+        count_force(employee_dict, period_start_date, period_end_date, force_dict,
+            department.force_types)
+        derive_rates(employee_dict)
+
+    panel, rows = write_department_outputs(recorder, department, output_data_folder,
+        employee_dict, officer_table, allegation_table, period_length, period_start_date,
+        period_end_date, output_format, panel_features)
+
+    if fit_model:
+        with recorder.stage('fit_model', rows) as stage:
+            results = fit_shrinkage(panel, 'civilian_allegations')
+            write_shrinkage_results(output_data_folder, panel, results, department.name)
+            stage['rows_out'] = len(results['police_ids'])
+        recorder.count(model_shape=results['shape'], model_dispersion=results['dispersion'])
+        for key in ['random_effects', 'time_period_results', 'police_id_results']:
+            recorder.add_output(key, os.path.join(output_data_folder,
+                f'{department.name}_{key}.csv'))
+
+    recorder.write_manifest(os.path.join(output_data_folder,
+        f'{department.name}_run_manifest.json'))
+
+    return recorder.manifest()
 
-    time_index = 0
-    gender_dict = {'F': 0, 'M': 1, ' ': 2}
-    race_dict = {'A': 0, 'B': 1, 'I': 2, 'T': 3, 'W': 4, 'H': 5, ' ': 6}
-    model_header = ['police_id', 'time_period', 'division', 'allegations', 
-    'race', 'gender', 'age', 'experience', 'full_name', 'force_count']
-    division_dict = {x: i for i, x in enumerate(community_divisions)}
-    model_dict = defaultdict(lambda: defaultdict(dict))
 
-    for emp_id, item in employee_dict.items():
-        if item['missing'] or item['error']:
-            continue
-        start_date = item['start_dates'][0]
-        end_date = item['end_dates'][-1]
-        switch_time_periods = []
-        for switch_date in employee_dict[emp_id]['switch_dates']:
-            switch_time_periods += [int(math.floor((switch_date - period_start_date).days / period_length))]
-        time_periods = range(int(math.floor((start_date - period_start_date).days / period_length)),
-            int(math.floor((end_date - period_start_date).days / period_length)))
-
-        for time_period in time_periods:
-            if time_period > int(math.floor((period_end_date - period_start_date).days / period_length)):
-                continue
-            if time_period <= 0:
-                continue
-            time_period_start = timedelta(days=period_length * time_period) + period_start_date
-            previous_idx = 0
-            for idx, start_date in enumerate(item['start_dates']):
-                if start_date > time_period_start:
-                    division = item['divisions'][previous_idx]
-                    if division not in community_divisions:
-                        break
-                    model_dict[emp_id][time_period] = defaultdict(int)
-                    model_dict[emp_id][time_period]['allegations'] = 0
-                    model_dict[emp_id][time_period]['civilian_allegations'] = 0
-                    model_dict[emp_id][time_period]['division'] = division_dict[division]
-                    model_dict[emp_id][time_period]['age'] = item['ages'][previous_idx]
-                    model_dict[emp_id][time_period]['experience'] = item['experiences'][previous_idx]
-                    model_dict[emp_id][time_period]['time_period_start'] = time_period_start
-                    model_dict[emp_id][time_period]['start_date'] = start_date
-                    model_dict[emp_id]['gender'] = gender_dict[employee_dict[emp_id]['gender']]
-                    model_dict[emp_id]['race'] = race_dict[employee_dict[emp_id]['race']]
-                    model_dict[emp_id]['full_name'] = employee_dict[emp_id]['full_name']
-                    model_dict[emp_id]['force_count'] = employee_dict[emp_id]['force_count']
-                    if time_period in switch_time_periods:
-                        model_dict[emp_id][time_period]['switch'] = True
-                    else:
-                        model_dict[emp_id][time_period]['switch'] = False
-                    break
-                previous_idx = idx
-
-    for allegation_id, item in allegation_dict.items():
-        emp_id = item['emp_id']
-        date = item['date']
-        if employee_dict[emp_id]['missing']:
-            continue
-        if item['division'] not in community_divisions:
-            continue
-        if date < period_start_date or date > period_end_date:
-            continue
-        time_period = int(math.floor((date - period_start_date).days / period_length))
-        if time_period not in model_dict[emp_id].keys():
-            continue
-        if not item['duplicate_control']:
-            if item['allegation_origin'] == 'Citizen':
-                model_dict[emp_id][time_period]['civilian_allegations'] += 1
-            model_dict[emp_id][time_period]['allegations'] += 1
-
-    with open(model_spreadsheet, 'w', newline='') as outfile, \
-            open(model_spreadsheet_citizen, 'w', newline='') as outfile_citizen:
-            # open(model_spreadsheet_citizen_sustained, 'w', newline='') as outfile_citizen:
-        writer = csv.writer(outfile, delimiter=',')
-        writer.writerow(model_header)
-        writer_citizen = csv.writer(outfile_citizen, delimiter=',')
-        writer_citizen.writerow(model_header)
-        for emp_id, emp_dict in model_dict.items():
-            for time_period, time_dict in emp_dict.items():
-                if emp_id == [' ']:
-                    continue
-                if time_period in ['gender', 'race', 'full_name', 'force_count']:
-                    continue
-                if time_dict['switch']:
-                    continue
-                output_row = [emp_id, time_period, time_dict['division'],
-                    time_dict['allegations'], emp_dict['race'],
-                    emp_dict['gender'], time_dict['age'],
-                    time_dict['experience'], emp_dict['full_name'], emp_dict['force_count']]
-                writer.writerow(output_row)
-                output_row = [emp_id, time_period, time_dict['division'],
-                    time_dict['civilian_allegations'], emp_dict['race'],
-                    emp_dict['gender'], time_dict['age'],
-                    time_dict['experience'], emp_dict['full_name'], emp_dict['force_count']]
-                writer_citizen.writerow(output_row)
+def preprocess_nashville(input_data_folder, output_data_folder, 
+        period_length=180, period_start_date=datetime(2009, 1, 1),
+        period_end_date=datetime(2018, 7, 18),
+        only_unique_control_nums=True, cache_folder=None, recorder=None,
+        fit_model=False, output_format='csv', panel_features=False):
+
+    return preprocess_department(NASHVILLE, input_data_folder, output_data_folder,
+        period_length, period_start_date, period_end_date,
+        only_unique_control_nums, cache_folder, recorder, fit_model, output_format,
+        panel_features)
+
+
+def sweep_nashville(input_data_folder, output_data_folder, period_configs,
+        cache_folder=None, department=NASHVILLE, output_format='csv',
+        panel_features=False):
+
+    """ Writes model formatted spreadsheets for several time period
+        configurations, parsing the input spreadsheets only once. Each
+        configuration is a dictionary with any of period_length,
+        period_start_date and period_end_date, defaulting as in
+        preprocess_nashville. Files are suffixed with the period length
+        and the start and end dates.
+    """
+
+    community_divisions = department.community_divisions
+    assignments, allegations, force = parse_department(department,
+        input_data_folder, cache_folder)
+    employee_dict, officer_table = load_assignments(assignments, department)
+    allegation_table = load_allegations(allegations, employee_dict, officer_table)
+    force_dict = load_force(force, employee_dict)
+    officer_index = index_officers(officer_table, allegation_table, community_divisions)
+    header = MODEL_HEADER + feature_header(len(community_divisions),
+        department.force_types) if panel_features else MODEL_HEADER
+
+    for period_config in period_configs:
+        period_length = period_config.get('period_length', 180)
+        period_start_date = period_config.get('period_start_date', datetime(2009, 1, 1))
+        period_end_date = period_config.get('period_end_date', datetime(2018, 7, 18))
+        suffix = '{}_{}_{}'.format(period_length, period_start_date.strftime('%Y%m%d'),
+            period_end_date.strftime('%Y%m%d'))
+
+        count_force(employee_dict, period_start_date, period_end_date, force_dict,
+            department.force_types)
+        panel = build_model_panel(employee_dict, officer_table, allegation_table,
+            community_divisions, period_length, period_start_date,
+            period_end_date, officer_index, department.race_codes,
+            department.gender_codes, force_types=department.force_types)
+        write_model_panel(os.path.join(output_data_folder, output_filename(
+            f'{department.name}_model_formatted_{suffix}', output_format)), panel,
+            output_format=output_format, header=header)
+        write_model_panel(os.path.join(output_data_folder, output_filename(
+            f'{department.name}_model_formatted_citizen_{suffix}', output_format)),
+            panel, 'civilian_allegations', output_format, header)
 
     return
 
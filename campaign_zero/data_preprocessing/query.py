@@ -0,0 +1,332 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+from campaign_zero.data_preprocessing.columnar import import_pyarrow
+from campaign_zero.data_preprocessing.dates import date_seconds, to_seconds
+from campaign_zero.data_preprocessing.departments import NASHVILLE, column_index
+from campaign_zero.data_preprocessing.instrumentation import json_default
+from campaign_zero.data_preprocessing.preprocess import read_csv
+
+
+def read_output(output_filename):
+
+    """ Returns the header and rows of a csv or parquet output, with the
+        rows as a 2D object array.
+    """
+
+    if output_filename.endswith('.parquet'):
+        pa = import_pyarrow()
+        table = pa.parquet.read_table(output_filename)
+        header = table.column_names
+        columns = list(table.to_pydict().values())
+    else:
+        header, columns = read_csv(output_filename)
+        header = header.tolist()
+    rows = np.empty((len(columns[0]) if columns else 0, len(header)), dtype=object)
+    for idx, column in enumerate(columns):
+        rows[:, idx] = column
+    return header, rows
+
+
+def group_rows(keys):
+
+    """ Returns a dictionary from each distinct key to the array of row
+        positions holding it, in row order.
+    """
+
+    keys = np.asarray(keys)
+    if not len(keys):
+        return {}
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(unique_keys)))[:-1]
+    return {key: rows for key, rows in zip(unique_keys.tolist(), np.split(order, bounds))}
+
+
+class QueryStore(object):
+
+    """ Answers questions about one department's preprocessed outputs from
+        indexes held in memory. Reads the outputs listed in the run
+        manifest that every preprocessing driver writes last, and reloads
+        them when a new manifest lands, checking at most every check_interval
+        seconds. Results of the last cache_size queries are cached, and
+        shared between callers, so treat them as read only. Safe to use
+        from several threads.
+    """
+
+    def __init__(self, output_data_folder, department=NASHVILLE, cache_size=1024,
+            check_interval=1.0):
+
+        self.output_data_folder = output_data_folder
+        self.department = department
+        self.cache_size = cache_size
+        self.check_interval = check_interval
+        self.manifest_filename = os.path.join(output_data_folder,
+            f'{department.name}_run_manifest.json')
+        self.lock = threading.RLock()
+        self.cache = OrderedDict()
+        self.signature = None
+        self.checked = 0
+        self.refresh()
+
+    def output_filename(self, key):
+
+        # Outputs are found next to the manifest, wherever the run wrote them.
+        return os.path.join(self.output_data_folder,
+            os.path.basename(self.manifest['outputs'][key]['filename']))
+
+    def refresh(self):
+
+        """ Reloads the outputs if the run manifest has changed since they
+            were loaded. Returns whether they were reloaded.
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            if self.signature is not None and now - self.checked < self.check_interval:
+                return False
+            self.checked = now
+            stat = os.stat(self.manifest_filename)
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if signature == self.signature:
+                return False
+            self.load()
+            self.signature = signature
+            return True
+
+    def load(self):
+
+        with open(self.manifest_filename, 'r') as openfile:
+            self.manifest = json.load(openfile)
+        settings = self.manifest['settings']
+        self.period_length = settings['period_length']
+        self.period_start_date = datetime.fromisoformat(settings['period_start_date'])
+
+        # Officers, by ID and by lower case full, first and last name.
+        self.officer_header, self.officers = read_output(self.output_filename('cop_details'))
+        emp_ids = self.officers[:, 0].tolist()
+        self.officer_rows = {emp_id: idx for idx, emp_id in enumerate(emp_ids)}
+        names = {}
+        first_names = self.officers[:, self.officer_header.index('first_name')].tolist()
+        last_names = self.officers[:, self.officer_header.index('last_name')].tolist()
+        for emp_id, first_name, last_name in zip(emp_ids, first_names, last_names):
+            for name in [f'{first_name} {last_name}', first_name, last_name]:
+                name = str(name or '').strip().lower()
+                if name:
+                    names.setdefault(name, []).append(emp_id)
+        self.names = names
+
+        # Allegations, by officer, and by division sorted by date.
+        self.allegation_header, self.allegations = read_output(
+            self.output_filename('allegations_extended'))
+        columns = self.department.allegation_columns
+        allegation_emp_ids = self.allegations[:, column_index(
+            self.allegation_header, columns['emp_id'])].astype(str)
+        self.allegation_times = to_seconds(self.department.parse_allegation_dates(
+            self.allegations[:, column_index(self.allegation_header, columns['date'])]))
+        self.allegations_by_officer = group_rows(allegation_emp_ids)
+        divisions = self.allegations[:, self.allegation_header.index('division')].astype(str)
+        order = np.argsort(self.allegation_times, kind='stable')
+        self.allegations_by_division = {None: order}
+        for division, rows in group_rows(divisions[order]).items():
+            self.allegations_by_division[division] = order[rows]
+
+        # Model panel periods, by officer and by time period.
+        self.panel_header, self.panel = read_output(self.output_filename('model_formatted'))
+        citizen_header, citizen_panel = read_output(
+            self.output_filename('model_formatted_citizen'))
+        allegation_column = self.panel_header.index('allegations')
+        self.panel_allegations = self.panel[:, allegation_column].astype(np.int64)
+        self.panel_civilian_allegations = citizen_panel[:, allegation_column].astype(np.int64)
+        self.panel_emp_ids = self.panel[:, self.panel_header.index('police_id')].astype(str)
+        self.panel_periods = self.panel[:, self.panel_header.index('time_period')].astype(np.int64)
+        if 'exposure_days' in self.panel_header:
+            self.panel_exposure = self.panel[:, self.panel_header.index(
+                'exposure_days')].astype(float)
+        else:
+            self.panel_exposure = np.full(len(self.panel), float(self.period_length))
+        self.periods_by_officer = group_rows(self.panel_emp_ids)
+        self.periods_by_time = group_rows(self.panel_periods)
+
+        self.cache.clear()
+
+        return
+
+    def cached(self, key, compute):
+
+        self.refresh()
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            result = compute()
+            self.cache[key] = result
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return result
+
+    def period_dates(self, time_period):
+
+        """ Returns the start and end dates of a model panel time period.
+        """
+
+        start = self.period_start_date + timedelta(self.period_length * time_period)
+        return start, start + timedelta(self.period_length)
+
+    def officer(self, emp_id):
+
+        """ Returns an officer's details, allegations and model panel periods
+            as dictionaries, or None for an unknown emp_id.
+        """
+
+        def compute():
+            if emp_id not in self.officer_rows:
+                return None
+            return {
+                'details': dict(zip(self.officer_header,
+                    self.officers[self.officer_rows[emp_id]].tolist())),
+                'allegations': [dict(zip(self.allegation_header, self.allegations[idx].tolist()))
+                    for idx in self.allegations_by_officer.get(emp_id, [])],
+                'periods': [dict(zip(self.panel_header, self.panel[idx].tolist()))
+                    for idx in self.periods_by_officer.get(emp_id, [])]}
+
+        return self.cached(('officer', emp_id), compute)
+
+    def find_officers(self, name):
+
+        """ Returns the IDs of officers whose full, first or last name is
+            name, ignoring case.
+        """
+
+        return self.cached(('find_officers', name.strip().lower()),
+            lambda: list(self.names.get(name.strip().lower(), [])))
+
+    def allegations_in(self, division=None, start_date=None, end_date=None,
+            time_period=None):
+
+        """ Returns the allegations made from start_date up to but excluding
+            end_date, or during a model panel time_period, as dictionaries
+            in date order. division limits them to allegations made while
+            the officer was assigned to it.
+        """
+
+        if time_period is not None:
+            start_date, end_date = self.period_dates(time_period)
+
+        def compute():
+            rows = self.allegations_by_division.get(division, np.zeros(0, dtype=np.int64))
+            times = self.allegation_times[rows]
+            first = 0 if start_date is None else np.searchsorted(times,
+                date_seconds(start_date), side='left')
+            last = len(rows) if end_date is None else np.searchsorted(times,
+                date_seconds(end_date), side='left')
+            return [dict(zip(self.allegation_header, self.allegations[idx].tolist()))
+                for idx in rows[first:last]]
+
+        return self.cached(('allegations_in', division, start_date, end_date), compute)
+
+    def top_officers(self, first_period=None, last_period=None, k=10, citizen=True,
+            min_exposure_days=0):
+
+        """ Ranks officers by their allegation rate per year of exposure over
+            the model panel periods from first_period to last_period,
+            inclusive, using civilian allegations if citizen is set.
+            Exposure is exposure_days where the panel has it, and otherwise
+            the period length for every period. Returns the top k as
+            dictionaries.
+        """
+
+        def compute():
+            periods = [rows for period, rows in self.periods_by_time.items()
+                if (first_period is None or period >= first_period) and
+                (last_period is None or period <= last_period)]
+            rows = np.concatenate(periods) if periods else np.zeros(0, dtype=np.int64)
+            emp_ids, owners = np.unique(self.panel_emp_ids[rows], return_inverse=True)
+            counts = self.panel_civilian_allegations if citizen else self.panel_allegations
+            allegations = np.bincount(owners, weights=counts[rows], minlength=len(emp_ids))
+            exposure = np.bincount(owners, weights=self.panel_exposure[rows],
+                minlength=len(emp_ids))
+            periods = np.bincount(owners, minlength=len(emp_ids))
+            eligible = np.flatnonzero((exposure > 0) & (exposure >= min_exposure_days))
+            rates = allegations[eligible] / exposure[eligible] * 365
+            ranked = eligible[np.lexsort((emp_ids[eligible], -rates))][:k]
+            full_names = self.panel[:, self.panel_header.index('full_name')]
+            return [{'emp_id': str(emp_ids[idx]), 'full_name': full_names[rows[owners == idx][0]],
+                'allegations': int(allegations[idx]), 'periods': int(periods[idx]),
+                'exposure_days': float(exposure[idx]),
+                'allegations_per_year': float(allegations[idx] / exposure[idx] * 365)}
+                for idx in ranked]
+
+        return self.cached(('top_officers', first_period, last_period, k, citizen,
+            min_exposure_days), compute)
+
+
+def serve(store, host='127.0.0.1', port=8765):
+
+    """ Serves a QueryStore as JSON over HTTP until interrupted, at
+        /officer/<emp_id>, /find?name=, /allegations?division=&start_date=
+        &end_date=&time_period= (dates as YYYY-MM-DD) and
+        /top?first_period=&last_period=&k=&citizen=&min_exposure_days=.
+    """
+
+    def optional(query, key, parse):
+        return parse(query[key][0]) if key in query else None
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            parts = [unquote(x) for x in url.path.strip('/').split('/')]
+            try:
+                if parts[0] == 'officer' and len(parts) == 2:
+                    result = store.officer(parts[1])
+                elif parts[0] == 'find':
+                    result = store.find_officers(query['name'][0])
+                elif parts[0] == 'allegations':
+                    result = store.allegations_in(optional(query, 'division', str),
+                        optional(query, 'start_date', datetime.fromisoformat),
+                        optional(query, 'end_date', datetime.fromisoformat),
+                        optional(query, 'time_period', int))
+                elif parts[0] == 'top':
+                    result = store.top_officers(optional(query, 'first_period', int),
+                        optional(query, 'last_period', int),
+                        optional(query, 'k', int) or 10,
+                        query.get('citizen', ['true'])[0].lower() != 'false',
+                        optional(query, 'min_exposure_days', float) or 0)
+                else:
+                    self.send_error(404)
+                    return
+            except (KeyError, ValueError) as error:
+                self.send_error(400, str(error))
+                return
+            body = json.dumps(result, default=json_default).encode()
+            self.send_response(200 if result is not None else 404)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    return
+
+
+if __name__ == '__main__':
+
+    serve(QueryStore('../../data/processed/nashville'))
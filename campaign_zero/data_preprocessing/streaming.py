@@ -0,0 +1,188 @@
+import os
+import csv
+import numpy as np
+
+from datetime import datetime
+
+from campaign_zero.data_preprocessing.columnar import output_filename, table_writer
+from campaign_zero.data_preprocessing.departments import NASHVILLE
+from campaign_zero.data_preprocessing.instrumentation import RunRecorder
+from campaign_zero.data_preprocessing.name_resolver import NameResolver
+from campaign_zero.data_preprocessing.preprocess import parse_assignments, \
+    read_csv_chunks, parse_allegation_rows, parse_force_rows, \
+    load_assignments, load_allegations, load_force, count_force, \
+    derive_rates, extended_allegation_rows, write_cop_details, \
+    EXTENDED_ALLEGATION_FIELDS, EXTENDED_EMPLOYEE_FIELDS
+from campaign_zero.data_preprocessing.tables import AllegationTable, MISSING_OFFICER
+from campaign_zero.data_preprocessing.panel import usable_emp_ids, \
+    flatten_allegations, index_officers, build_model_panel, write_model_panel, \
+    feature_header, MODEL_HEADER
+
+
+def iter_allegations(allegations_filename, department=NASHVILLE, chunk_rows=100000):
+
+    for header, columns in read_csv_chunks(allegations_filename, chunk_rows):
+        yield parse_allegation_rows(header, columns, department)
+
+
+def iter_force(force_filename, department=NASHVILLE, chunk_rows=100000):
+
+    for header, columns in read_csv_chunks(force_filename, chunk_rows,
+            department.force_columns):
+        yield parse_force_rows(header, columns, department)
+
+
+def preprocess_department_streaming(department, input_data_folder,
+        output_data_folder, period_length=180,
+        period_start_date=datetime(2009, 1, 1),
+        period_end_date=datetime(2018, 7, 18), chunk_rows=100000,
+        output_format='csv', panel_features=False, recorder=None):
+
+    """ Same outputs as preprocess_department, reading the allegations and
+        use of force spreadsheets chunk_rows rows at a time instead of
+        holding them in memory. The first pass builds the officer table and
+        employee counts, keeping the allegation IDs seen, the latest row of
+        each ID repeated across chunks, and each force incident's merged
+        force codes for deduplication. The second pass re-reads the
+        allegations, enriching each chunk and writing it straight to the
+        extended allegations spreadsheet, with one row per allegation ID as
+        in preprocess_department, and keeps only the owner, date and origin
+        of the allegations counted in the panel. The run manifest is written
+        last, as by preprocess_department. Returns the manifest.
+    """
+
+    if recorder is None:
+        recorder = RunRecorder()
+    recorder.settings.update({'department': department.name,
+        'period_length': period_length, 'period_start_date': period_start_date,
+        'period_end_date': period_end_date, 'chunk_rows': chunk_rows,
+        'output_format': output_format, 'panel_features': panel_features})
+    filenames = {key: os.path.join(input_data_folder, filename)
+        for key, filename in department.filenames.items()}
+    for key, filename in filenames.items():
+        recorder.add_input(key, filename)
+    community_divisions = department.community_divisions
+
+    with recorder.stage('load_assignments') as stage:
+        employee_dict, officer_table = load_assignments(
+            parse_assignments(filenames['assignments'], department), department)
+        stage['rows_out'] = len(officer_table)
+    officer_codes = {emp_id: code for code, emp_id in enumerate(usable_emp_ids(officer_table))}
+    division_dict = {x: i for i, x in enumerate(community_divisions)}
+
+    # First pass, counting allegations and attributing force. Rows whose
+    # allegation ID was seen in an earlier chunk are kept aside, latest
+    # values winning, for the second pass to write at the ID's first row.
+    all_control_numbers = set()
+    allegation_ids = set()
+    repeated = None
+    original_header = None
+    with recorder.stage('load_allegations') as stage:
+        for allegations in iter_allegations(filenames['allegations'], department, chunk_rows):
+            allegation_table = load_allegations(allegations, employee_dict, officer_table,
+                all_control_numbers=all_control_numbers)
+            original_header = allegation_table.header
+            chunk_ids = allegation_table.allegation_ids.tolist()
+            seen = np.array([x in allegation_ids for x in chunk_ids], dtype=bool)
+            if seen.any():
+                if repeated is None:
+                    repeated = AllegationTable(original_header, officer_table)
+                repeated.extend(allegation_table.select(seen))
+            allegation_ids.update(chunk_ids)
+        stage['rows_out'] = len(allegation_ids)
+    if original_header is None:
+        with open(filenames['allegations'], 'r') as openfile:
+            original_header = next(csv.reader(openfile, delimiter=','))
+    if repeated is None:
+        repeated = AllegationTable(original_header, officer_table)
+    del allegation_ids
+
+    force_dict = {}
+    force_stats = {}
+    with recorder.stage('load_force') as stage:
+        name_resolver = NameResolver(employee_dict)
+        for force in iter_force(filenames['force'], department, chunk_rows):
+            load_force(force, employee_dict, force_dict, name_resolver, force_stats)
+        stage['rows_out'] = len(force_dict)
+    recorder.count(**force_stats)
+    with recorder.stage('derive_rates', len(employee_dict)):
+        count_force(employee_dict, period_start_date, period_end_date, force_dict,
+            department.force_types)
+        derive_rates(employee_dict)
+
+    # Second pass, writing the extended allegations and keeping the owner,
+    # date and origin of those counted in the panel.
+    all_control_numbers = set()
+    repeated_ids = set(repeated.allegation_ids.tolist())
+    written_ids = set()
+    flat_chunks = []
+    panel_stats = {}
+    counts = {'allegations_missing_officer': 0, 'duplicate_control': 0}
+    allegations_plus = os.path.join(output_data_folder, output_filename(
+        f'{department.name}_allegations_extended', output_format))
+    header = original_header + EXTENDED_ALLEGATION_FIELDS + EXTENDED_EMPLOYEE_FIELDS
+    with recorder.stage('write_details') as stage:
+        extended_rows = 0
+        with table_writer(allegations_plus, header, output_format) as writer:
+            for allegations in iter_allegations(filenames['allegations'], department,
+                    chunk_rows):
+                allegation_table = load_allegations(allegations, employee_dict,
+                    officer_table, all_control_numbers=all_control_numbers,
+                    update_employees=False)
+                if repeated_ids:
+                    chunk_ids = allegation_table.allegation_ids.tolist()
+                    allegation_table = allegation_table.select(np.array(
+                        [x not in written_ids for x in chunk_ids], dtype=bool))
+                    allegation_table.extend(repeated.select(np.isin(
+                        repeated.allegation_ids, allegation_table.allegation_ids)))
+                    written_ids.update(x for x in chunk_ids if x in repeated_ids)
+                writer.writerows(extended_allegation_rows(allegation_table, employee_dict))
+                flat_chunks += [flatten_allegations(allegation_table, officer_codes,
+                    division_dict, panel_stats)]
+                counts['allegations_missing_officer'] += int(np.sum(
+                    allegation_table.assignment_rows == MISSING_OFFICER))
+                counts['duplicate_control'] += int(allegation_table.duplicate_control.sum())
+                extended_rows += len(allegation_table)
+        write_cop_details(output_data_folder, employee_dict, department, output_format)
+        stage['rows_out'] = extended_rows + len(employee_dict)
+    recorder.count(missing_officers=sum(1 for x in employee_dict.values() if x['missing']),
+        **counts)
+    recorder.add_output('allegations_extended', allegations_plus, extended_rows)
+    recorder.add_output('cop_details', os.path.join(output_data_folder,
+        output_filename(f'{department.name}_cop_details', output_format)),
+        len(employee_dict))
+
+    if flat_chunks:
+        flat_allegations = tuple(np.concatenate(x) for x in zip(*flat_chunks))
+    else:
+        flat_allegations = flatten_allegations(AllegationTable(original_header,
+            officer_table), officer_codes, division_dict)
+    with recorder.stage('build_model_panel', len(flat_allegations[0])) as stage:
+        officer_index = index_officers(officer_table, None, community_divisions,
+            flat_allegations, panel_stats)
+        panel = build_model_panel(employee_dict, officer_table, None,
+            community_divisions, period_length, period_start_date, period_end_date,
+            officer_index, department.race_codes, department.gender_codes,
+            stats=panel_stats, force_types=department.force_types)
+        stage['rows_out'] = len(panel['switch'])
+    recorder.count(**panel_stats)
+
+    model_spreadsheet = os.path.join(output_data_folder, output_filename(
+        f'{department.name}_model_formatted', output_format))
+    model_spreadsheet_citizen = os.path.join(output_data_folder, output_filename(
+        f'{department.name}_model_formatted_citizen', output_format))
+    with recorder.stage('write_model_panel', len(panel['switch'])) as stage:
+        header = MODEL_HEADER + feature_header(len(community_divisions),
+            department.force_types) if panel_features else MODEL_HEADER
+        rows = write_model_panel(model_spreadsheet, panel, output_format=output_format,
+            header=header)
+        write_model_panel(model_spreadsheet_citizen, panel, 'civilian_allegations',
+            output_format, header)
+        stage['rows_out'] = rows
+    recorder.add_output('model_formatted', model_spreadsheet, rows)
+    recorder.add_output('model_formatted_citizen', model_spreadsheet_citizen, rows)
+
+    recorder.write_manifest(os.path.join(output_data_folder,
+        f'{department.name}_run_manifest.json'))
+
+    return recorder.manifest()
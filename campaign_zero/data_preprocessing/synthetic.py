@@ -0,0 +1,239 @@
+import os
+import csv
+import numpy as np
+
+from datetime import datetime
+
+from campaign_zero.data_preprocessing.departments import NASHVILLE
+
+
+ASSIGNMENT_HEADER = ['emp_id', 'bureau', 'division', 'section', 'start', 'end',
+    'hire', 'race', 'gender', 'age']
+ALLEGATION_HEADER = ['year_occurred', 'ControlNumber', 'date_reported',
+    'personnel_lname', 'personnel_fname', 'personnel_race', 'personnel_empno',
+    'Complainant_Sex', 'Complainant_Race', 'allegation_id', 'infraction',
+    'ViolationCode', 'Originated', 'disposition', 'Final_Disposition_Date',
+    'incident_type']
+FORCE_HEADER = ['INCIDENT_NUM', 'LOCATION', 'INC_DATE', 'FORCE_WFIREARM',
+    'FORCE_WBATON', 'FORCE_WK9', 'FORCE_WCS', 'FORCE_WTEAR', 'FORCE_WTAZ',
+    'FORCE_WOTHER', 'FORCE_PFOOT', 'FORCE_PHAND', 'FORCE_PTAKED', 'FORCE_PGRAP',
+    'OFFICERS_INVOLVED', 'SUBJECT_RACE', 'INJ_OFFICER', 'INJ_SUSPECT', 'SRACE']
+
+# Roughly the size of the Nashville data, per unit of scale.
+NASHVILLE_OFFICERS = 2400
+NASHVILLE_ALLEGATIONS = 18000
+NASHVILLE_FORCE = 3600
+
+MONTHS = np.array(['January', 'February', 'March', 'April', 'May', 'June',
+    'July', 'August', 'September', 'October', 'November', 'December'])
+OTHER_DIVISIONS = ['Training Division', 'Records Division', 'Specialized Investigations Division']
+BUREAUS = ['Patrol Bureau', 'Investigative Services Bureau', 'Administrative Services Bureau']
+RACES = [' ', 'A', 'B', 'H', 'I', 'W']
+RACE_WEIGHTS = [0.01, 0.02, 0.2, 0.04, 0.01, 0.72]
+FIRST_NAMES = ['James', 'John', 'Robert', 'Michael', 'William', 'David', 'Mary',
+    'Patricia', 'Jennifer', 'Linda', 'Elizabeth', 'Barbara', 'Richard', 'Joseph',
+    'Thomas', 'Charles', 'Susan', 'Jessica', 'Sarah', 'Karen']
+SYLLABLES = ['son', 'ton', 'man', 'ley', 'well', 'wood', 'er', 'ing', 'by',
+    'ford', 'ham', 'ins', 'ster', 'field', 'ard', 'ridge', 'low', 'mont', 'berg',
+    'dale', 'kin', 'lan', 'cor', 'bell', 'ash', 'hart', 'wick', 'ros', 'vin', 'tal']
+
+
+def to_days(date):
+
+    return int((np.datetime64(date, 'D') - np.datetime64('1970-01-01', 'D')).astype(np.int64))
+
+
+def format_days(days, fmt):
+
+    """ Formats an array of days since 1970 as 'assignment', 'allegation'
+        or 'force' dates, in the Nashville spreadsheets' formats.
+    """
+
+    dates = np.asarray(days, dtype=np.int64).astype('datetime64[D]')
+    if fmt == 'assignment':
+        return np.char.add(np.datetime_as_string(dates, unit='D'), ' 00:00:00.000')
+    years = dates.astype('datetime64[Y]').astype(np.int64) + 1970
+    months = dates.astype('datetime64[M]').astype(np.int64) % 12
+    month_days = (dates - dates.astype('datetime64[M]')).astype(np.int64) + 1
+    if fmt == 'allegation':
+        return np.char.add(np.char.add(np.char.add(MONTHS[months], ' '),
+            np.char.zfill(month_days.astype(str), 2)), np.char.add(', ', years.astype(str)))
+    return np.char.add(np.char.add(np.char.add((months + 1).astype(str), '/'),
+        np.char.add(month_days.astype(str), '/')), years.astype(str))
+
+
+def last_name_pool(rng, size):
+
+    """ Returns size distinct made up upper case last names of two to four
+        syllables.
+    """
+
+    base = len(SYLLABLES)
+    numbers = rng.choice(base ** 2 + base ** 3 + base ** 4, size, replace=False)
+    names = []
+    for number in numbers.tolist():
+        count = 2
+        while number >= base ** count:
+            number -= base ** count
+            count += 1
+        syllables = []
+        for idx in range(count):
+            number, digit = divmod(number, base)
+            syllables += [SYLLABLES[digit]]
+        names += [''.join(syllables).upper()]
+    return names
+
+
+def sample_active(rng, starts, ends, weights, size, first_day, last_day):
+
+    """ Picks size (officer, day) pairs, choosing officers in proportion to
+        weights and days uniformly within each officer's service clipped to
+        [first_day, last_day]. Officers without days in range are skipped.
+    """
+
+    starts = np.maximum(starts, first_day)
+    ends = np.minimum(ends, last_day)
+    weights = np.where(ends > starts, weights, 0)
+    officers = rng.choice(len(starts), size, p=weights / weights.sum())
+    days = starts[officers] + (rng.random(size) * (ends[officers] - starts[officers])).astype(np.int64)
+    return officers, days
+
+
+def generate_department(output_data_folder, scale=1.0, seed=0,
+        num_officers=None, num_allegations=None, num_force=None,
+        assignment_churn=4.0, mean_assignment_days=600, name_collision_rate=0.33,
+        missing_rate=0.1, error_rate=0.01, duplicate_control_rate=0.14,
+        duplicate_incident_rate=0.03, first_date=datetime(2005, 1, 1),
+        last_date=datetime(2018, 7, 18), department=NASHVILLE):
+
+    """ Writes seeded synthetic assignments, allegations and use of force
+        spreadsheets in the Nashville layout, named after department. Counts
+        default to the size of the Nashville data times scale.
+        assignment_churn is the mean number of assignments after an
+        officer's first. name_collision_rate is roughly the fraction of
+        officers sharing a last name with another, missing_rate the fraction
+        of allegations against officers without assignments, and error_rate
+        the fraction of officers with an unusable gender. Allegations and
+        incidents fall between first_date and last_date.
+    """
+
+    rng = np.random.default_rng(seed)
+    num_officers = num_officers or int(NASHVILLE_OFFICERS * scale)
+    num_allegations = num_allegations or int(NASHVILLE_ALLEGATIONS * scale)
+    num_force = num_force or int(NASHVILLE_FORCE * scale)
+    first_day, last_day = to_days(first_date), to_days(last_date)
+    open_end_day = to_days(department.open_end_date)
+    os.makedirs(output_data_folder, exist_ok=True)
+
+    # Officers.
+    emp_ids = rng.choice(np.arange(100000, 100000 + 10 * num_officers),
+        num_officers, replace=False).astype(str)
+    last_names = np.array(last_name_pool(rng, max(int(num_officers *
+        (1 - name_collision_rate)), 1)))[rng.integers(0,
+        max(int(num_officers * (1 - name_collision_rate)), 1), num_officers)]
+    first_names = np.array(FIRST_NAMES)[rng.integers(0, len(FIRST_NAMES), num_officers)]
+    races = rng.choice(RACES, num_officers, p=RACE_WEIGHTS)
+    genders = np.where(rng.random(num_officers) < 0.8, 'M', 'F')
+    genders[rng.random(num_officers) < error_rate] = ' '
+    hire_ages = rng.integers(21, 40, num_officers)
+    hire_days = rng.integers(first_day - 20 * 365, last_day - 365, num_officers)
+    officer_starts = hire_days + rng.integers(0, 200, num_officers)
+
+    # Back to back assignments up to last_date, the last one open ended for
+    # officers still active then.
+    counts = 1 + rng.poisson(assignment_churn, num_officers)
+    owners = np.repeat(np.arange(num_officers), counts)
+    durations = rng.integers(30, 2 * mean_assignment_days - 30, len(owners))
+    totals = np.cumsum(durations)
+    group_starts = np.concatenate([[0], np.cumsum(counts)])[:-1]
+    ends = officer_starts[owners] + totals - np.repeat(totals[group_starts] -
+        durations[group_starts], counts)
+    starts = ends - durations + 1
+    keep = starts <= last_day
+    owners, starts, ends = owners[keep], starts[keep], ends[keep]
+    lasts = np.cumsum(np.bincount(owners, minlength=num_officers)) - 1
+    open_ended = np.zeros(len(owners), dtype=bool)
+    open_ended[lasts] = ends[lasts] > last_day
+    end_days = np.where(open_ended, open_end_day, ends)
+    officer_ends = np.minimum(ends[lasts], last_day)
+    divisions = np.array(department.community_divisions + OTHER_DIVISIONS)
+    ages = hire_ages[owners] + (starts - hire_days[owners]) // 365
+
+    with open(os.path.join(output_data_folder, department.filenames['assignments']),
+            'w', newline='') as outfile:
+        writer = csv.writer(outfile, delimiter=',')
+        writer.writerow(ASSIGNMENT_HEADER)
+        writer.writerows(zip(emp_ids[owners],
+            np.array(BUREAUS)[rng.integers(0, len(BUREAUS), len(owners))],
+            divisions[rng.integers(0, len(divisions), len(owners))],
+            np.char.add('Section ', rng.integers(1, 6, len(owners)).astype(str)),
+            format_days(starts, 'assignment'), format_days(end_days, 'assignment'),
+            format_days(hire_days[owners], 'assignment'), races[owners],
+            genders[owners], ages))
+
+    # Allegations, some against officers missing from the assignments.
+    weights = rng.gamma(0.7, 1.0, num_officers)
+    officers, days = sample_active(rng, officer_starts, officer_ends, weights,
+        num_allegations, first_day, last_day)
+    num_missing = int(num_allegations * missing_rate)
+    missing_ids = (10 ** 6 + rng.integers(0, max(num_missing // 4, 1), num_missing)).astype(str)
+    missing_names = np.array(last_name_pool(rng, max(num_missing // 4, 1)))[
+        rng.integers(0, max(num_missing // 4, 1), num_missing)]
+    allegation_emp_ids = np.concatenate([emp_ids[officers], missing_ids])
+    allegation_last_names = np.concatenate([last_names[officers], missing_names])
+    allegation_first_names = np.concatenate([first_names[officers],
+        np.array(FIRST_NAMES)[rng.integers(0, len(FIRST_NAMES), num_missing)]])
+    allegation_races = np.concatenate([races[officers], rng.choice(RACES, num_missing, p=RACE_WEIGHTS)])
+    days = np.concatenate([days, rng.integers(first_day, last_day, num_missing)])
+    order = np.argsort(days, kind='stable')
+    days = days[order]
+    size = len(days)
+    control_numbers = np.cumsum(rng.random(size) >= duplicate_control_rate)
+
+    with open(os.path.join(output_data_folder, department.filenames['allegations']),
+            'w', newline='') as outfile:
+        writer = csv.writer(outfile, delimiter=',')
+        writer.writerow(ALLEGATION_HEADER)
+        writer.writerows(zip(days.astype('datetime64[D]').astype('datetime64[Y]').astype(str),
+            np.char.add('C', control_numbers.astype(str)), format_days(days, 'allegation'),
+            np.char.capitalize(allegation_last_names[order]), allegation_first_names[order],
+            allegation_races[order], allegation_emp_ids[order],
+            rng.choice(['Male', 'Female'], size), rng.choice(['White', 'Black', 'Hispanic'], size),
+            np.arange(10 ** 5, 10 ** 5 + size).astype(str),
+            rng.choice(['Rude', 'Behavior', 'Neglect of Duty', 'Use of Force'], size),
+            [''] * size, rng.choice([department.citizen_origin, 'Supervisor'], size),
+            rng.choice(['Sustained', 'Unfounded', 'Exonerated'], size), [''] * size,
+            rng.choice(['Disciplinary Trk - Access', 'Complaint'], size)))
+
+    # Use of force incidents, with one to three officers each and some
+    # incidents listed more than once.
+    officers, days = sample_active(rng, officer_starts, officer_ends, weights,
+        num_force, first_day, last_day)
+    # Each extra officer is the first of 20 random draws active on the day.
+    involved = [[last_names[officer]] for officer in officers]
+    slots = np.repeat(np.arange(num_force), rng.geometric(0.65, num_force) - 1)
+    draws = rng.integers(0, num_officers, (len(slots), 20))
+    slot_days = days[slots][:, None]
+    draws_active = (officer_starts[draws] <= slot_days) & (officer_ends[draws] >= slot_days)
+    found = draws_active.any(axis=1)
+    others = draws[np.arange(len(slots)), draws_active.argmax(axis=1)]
+    for slot, other in zip(slots[found].tolist(), others[found].tolist()):
+        involved[slot] += [last_names[other]]
+    incident_nums = (days.astype('datetime64[D]').astype('datetime64[Y]').astype(np.int64) +
+        1970) * 10 ** 6 + np.arange(num_force)
+    repeats = np.flatnonzero(rng.random(num_force) < duplicate_incident_rate)
+    rows = np.concatenate([np.arange(num_force), repeats])
+    rows = rows[np.argsort(np.concatenate([days, days[repeats]]), kind='stable')]
+    force_codes = (rng.random((num_force, 11)) < 0.12).astype(int)
+
+    with open(os.path.join(output_data_folder, department.filenames['force']),
+            'w', newline='') as outfile:
+        writer = csv.writer(outfile, delimiter=',')
+        writer.writerow(FORCE_HEADER)
+        dates = format_days(days, 'force')
+        for idx in rows:
+            writer.writerow([incident_nums[idx], f'{rng.integers(1, 9999)} MAIN ST', dates[idx]] +
+                force_codes[idx].tolist() + [';'.join(involved[idx]), rng.choice(RACES[1:]),
+                int(rng.random() < 0.02), int(rng.random() < 0.2), rng.choice(RACES[1:])])
+
+    return
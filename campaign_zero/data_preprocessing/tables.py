@@ -0,0 +1,363 @@
+import numpy as np
+
+from bisect import bisect_left
+from datetime import datetime
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Assignment rows of allegations made before an officer's first assignment
+# ended, and of allegations against officers with no assignments.
+UNASSIGNED = -1
+MISSING_OFFICER = -2
+
+
+class Categorical(object):
+
+    """ A column of strings stored as integer codes into a list of categories.
+    """
+
+    def __init__(self, values):
+
+        categories, codes = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+        self.categories = categories.tolist()
+        self.codes = codes.astype(np.int32)
+
+    def __getitem__(self, idx):
+
+        return self.categories[self.codes[idx]]
+
+
+def find_assignment_index(end_dates, date, sorted_end_dates=True):
+
+    """ Returns (index, during_assignment) for the assignment active on date.
+        index is None if the date falls before the first assignment ends,
+        and during_assignment is False if the date is after the last one.
+        Uses a binary search when end_dates is non-decreasing, which it
+        is for all but malformed assignment histories.
+    """
+
+    if sorted_end_dates:
+        date_index = bisect_left(end_dates, date)
+        if date_index == 0 and date < end_dates[0]:
+            return None, False
+        if date_index == len(end_dates):
+            return len(end_dates) - 1, False
+        return date_index, True
+
+    previous_end_date = datetime(1900, 1, 1)
+    for date_index, end_date in enumerate(end_dates):
+        if date_index == 0 and date < end_date:
+            return None, False
+        if date <= end_date and date > previous_end_date:
+            return date_index, True
+        previous_end_date = end_date
+    return len(end_dates) - 1, False
+
+
+def group_keys(groups, values, query_groups, query_values):
+
+    """ Combines integer group codes and values into single keys that sort
+        by group and then by value, for a sorted search array and for the
+        queries into it. Offsetting values by group keeps them in order
+        across groups, so one np.searchsorted covers every group. Returns
+        (keys, query_keys).
+    """
+
+    low = min(x.min() for x in [values, query_values] if len(x))
+    span = int(max(x.max() for x in [values, query_values] if len(x)) - low) + 1
+    return groups * span + (values - low), query_groups * span + (query_values - low)
+
+
+def group_firsts(offsets):
+
+    """ Returns a boolean array marking the first row of each group.
+    """
+
+    firsts = np.zeros(offsets[-1], dtype=bool)
+    firsts[offsets[:-1][offsets[:-1] < offsets[1:]]] = True
+    return firsts
+
+
+class OfficerTable(object):
+
+    """ Officer assignment histories stored as arrays. Each assignment
+        column holds every officer's assignments back to back, in the order
+        they appear in the spreadsheet, and the assignments of the officer
+        with code i are rows offsets[i] to offsets[i + 1]. Bureau, division
+        and section are Categoricals, and the officer level gender and race
+        columns are taken from each officer's last assignment row. The
+        department supplies the community divisions, the valid genders and
+        the data retrieval date.
+    """
+
+    def __init__(self, assignments, department):
+
+        self.data_retrieval_date = department.data_retrieval_date
+
+        # Officer codes in order of first appearance.
+        unique_ids, first_rows, row_codes = np.unique(assignments['emp_ids'],
+            return_index=True, return_inverse=True)
+        order = np.argsort(first_rows, kind='stable')
+        recode = np.empty(len(order), dtype=np.int64)
+        recode[order] = np.arange(len(order))
+        row_codes = recode[row_codes]
+        self.emp_ids = unique_ids[order].tolist()
+        self.index = {emp_id: code for code, emp_id in enumerate(self.emp_ids)}
+
+        permutation = np.argsort(row_codes, kind='stable')
+        lengths = np.bincount(row_codes, minlength=len(self.emp_ids))
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        firsts = group_firsts(self.offsets)
+        lasts = self.offsets[1:] - 1
+
+        # Assignment columns.
+        self.bureaus = Categorical(assignments['bureaus'][permutation])
+        self.divisions = Categorical(assignments['divisions'][permutation])
+        self.sections = Categorical(assignments['sections'][permutation])
+        self.ages = assignments['ages'][permutation].astype(np.int16)
+        self.start_dates = assignments['start_dates'][permutation]
+        hire_dates = assignments['hire_dates'][permutation]
+        self.experiences = ((self.start_dates - hire_dates).astype(np.int64)
+            // SECONDS_PER_DAY).astype(np.int32)
+
+        # Open ended assignments end when the previous one did, or when the
+        # data was retrieved if they are an officer's first assignment.
+        end_dates = assignments['end_dates'][permutation]
+        open_ended = assignments['open_ended'][permutation]
+        end_dates = np.where(open_ended & firsts,
+            np.datetime64(self.data_retrieval_date, 's'), end_dates)
+        known = np.where(open_ended & ~firsts, 0, np.arange(len(end_dates)))
+        self.end_dates = end_dates[np.maximum.accumulate(known)]
+
+        # Division switches between consecutive assignments.
+        community = np.isin(np.arange(len(self.divisions.categories)),
+            [idx for idx, x in enumerate(self.divisions.categories)
+                if x in department.community_divisions])
+        division_codes = self.divisions.codes
+        previous_codes = np.roll(division_codes, 1)
+        self.switch = ~firsts & (division_codes != previous_codes)
+        self.community_switch = self.switch & community[division_codes] & community[previous_codes]
+
+        # Officer columns. Errors only reflect each officer's last row, as
+        # the flag is reset on every row.
+        genders = assignments['genders'][permutation][lasts]
+        self.genders = Categorical(genders)
+        self.races = Categorical(assignments['races'][permutation][lasts])
+        self.hire_dates = hire_dates[lasts]
+        self.errors = ~np.isin(genders, department.valid_genders) | (self.ages[lasts] > 100) | \
+            (open_ended[lasts] & firsts[lasts])
+        if len(self.emp_ids):
+            self.max_ages = np.maximum.reduceat(self.ages, self.offsets[:-1])
+            self.switches = np.add.reduceat(self.switch.astype(np.int64), self.offsets[:-1])
+            self.community_switches = np.add.reduceat(
+                self.community_switch.astype(np.int64), self.offsets[:-1])
+        else:
+            self.max_ages = self.switches = self.community_switches = np.zeros(0, dtype=np.int64)
+        self.sorted_end_dates = np.ones(len(self.emp_ids), dtype=bool)
+        unsorted = np.flatnonzero(~firsts & (self.end_dates < np.roll(self.end_dates, 1)))
+        self.sorted_end_dates[np.searchsorted(self.offsets, unsorted, side='right') - 1] = False
+
+    def __len__(self):
+
+        return len(self.emp_ids)
+
+    def __contains__(self, emp_id):
+
+        return emp_id in self.index
+
+    def find_assignment(self, emp_id, time):
+
+        """ Returns (row, during_assignment) for the assignment active at
+            time, in seconds since 1970-01-01, where row indexes the
+            assignment columns or is None.
+        """
+
+        code = self.index[emp_id]
+        first = self.offsets[code]
+        date_index, during_assignment = find_assignment_index(
+            self.end_dates[first:self.offsets[code + 1]],
+            np.datetime64(time, 's'), self.sorted_end_dates[code])
+        if date_index is None:
+            return None, during_assignment
+        return first + date_index, during_assignment
+
+    def find_assignments(self, emp_ids, times):
+
+        """ find_assignment for arrays of emp_ids and times. Returns arrays
+            of rows and during_assignment, with rows UNASSIGNED where
+            find_assignment returns None and MISSING_OFFICER for officers
+            not in the table.
+        """
+
+        emp_ids = np.asarray(emp_ids).tolist()
+        times = np.asarray(times, dtype=np.int64)
+        codes = np.array([self.index.get(x, -1) for x in emp_ids], dtype=np.int64)
+        rows = np.full(len(codes), MISSING_OFFICER, dtype=np.int64)
+        during_assignment = np.zeros(len(codes), dtype=bool)
+        known = np.flatnonzero(codes >= 0)
+        if not len(known):
+            return rows, during_assignment
+
+        # One search covers every officer whose end dates are sorted.
+        ends = self.end_dates.astype('datetime64[s]').astype(np.int64)
+        owners = np.repeat(np.arange(len(self.emp_ids)), np.diff(self.offsets))
+        codes = codes[known]
+        positions = np.searchsorted(*group_keys(owners, ends, codes, times[known]))
+        firsts, lasts = self.offsets[codes], self.offsets[codes + 1] - 1
+        before = (positions == firsts) & (times[known] < ends[firsts])
+        rows[known] = np.where(before, UNASSIGNED, np.minimum(positions, lasts))
+        during_assignment[known] = ~before & (positions <= lasts)
+
+        for idx in known[~self.sorted_end_dates[codes]].tolist():
+            row, during_assignment[idx] = self.find_assignment(emp_ids[idx], int(times[idx]))
+            rows[idx] = UNASSIGNED if row is None else row
+
+        return rows, during_assignment
+
+    def assignment_field(self, field, row):
+
+        """ Returns the bureau, division, section, age or experience of an
+            assignment row.
+        """
+
+        if field in ['bureau', 'division', 'section']:
+            return getattr(self, field + 's')[row]
+        return int(getattr(self, field + 's')[row])
+
+    def officer_fields(self, code):
+
+        """ Returns the per officer fields derived from an assignment history.
+        """
+
+        first, last = self.offsets[code], self.offsets[code + 1] - 1
+        start_date = self.start_dates[first].item()
+        end_date = self.end_dates[last].item()
+        hire_date = self.hire_dates[code].item()
+        return {
+            'error': bool(self.errors[code]),
+            'gender': self.genders[code],
+            'race': self.races[code],
+            'max_age': int(self.max_ages[code]),
+            'hire_date': hire_date,
+            'max_experience': (self.data_retrieval_date - hire_date).days,
+            'start_date': start_date,
+            'end_date': end_date,
+            'days_assigned': (end_date - start_date).days + 1,
+            'switches': int(self.switches[code]),
+            'community_switches': int(self.community_switches[code]),
+            'sorted_end_dates': bool(self.sorted_end_dates[code]),
+            'active': end_date.date() >= self.data_retrieval_date.date()}
+
+
+class AllegationTable(object):
+
+    """ Allegations stored as arrays, one row per allegation ID in the order
+        IDs first appear, holding the values of the ID's latest row. The
+        original spreadsheet columns are kept for the extended allegations
+        spreadsheet. Times are seconds since 1970-01-01, and assignment_rows
+        index officer_table's assignment columns, or are UNASSIGNED or
+        MISSING_OFFICER. Gender and race are looked up from the officer
+        when needed, as they do not change between allegations.
+    """
+
+    COLUMNS = {'allegation_ids': str, 'emp_ids': str, 'times': np.int64, 'citizen': bool,
+        'duplicate_control': bool, 'assignment_rows': np.int64, 'during_assignment': bool}
+
+    def __init__(self, header, officer_table):
+
+        self.header = list(header)
+        self.officer_table = officer_table
+        self.original_columns = [np.zeros(0, dtype=str) for x in self.header]
+        for key, dtype in self.COLUMNS.items():
+            setattr(self, key, np.zeros(0, dtype=dtype))
+
+    def __len__(self):
+
+        return len(self.allegation_ids)
+
+    def append(self, original_columns, columns):
+
+        """ Adds rows given as the original columns and a dictionary of
+            COLUMNS. A row whose allegation ID is already in the table, or
+            comes up again later in the rows, gives its values to the first
+            row with that ID.
+        """
+
+        unique_ids, firsts, inverse = np.unique(columns['allegation_ids'],
+            return_index=True, return_inverse=True)
+        latest = np.zeros(len(unique_ids), dtype=np.int64)
+        latest[inverse.ravel()] = np.arange(len(inverse))
+
+        existing = np.zeros(len(unique_ids), dtype=bool)
+        targets = np.zeros(0, dtype=np.int64)
+        if len(self) and len(unique_ids):
+            order = np.argsort(self.allegation_ids, kind='stable')
+            positions = np.minimum(np.searchsorted(self.allegation_ids[order], unique_ids),
+                len(order) - 1)
+            existing = self.allegation_ids[order][positions] == unique_ids
+            targets = order[positions[existing]]
+        replacing = latest[existing]
+        added = np.flatnonzero(~existing)
+        added = latest[added[np.argsort(firsts[added], kind='stable')]]
+
+        def merge(old, new):
+            new = np.asarray(new)
+            if old.dtype.kind == 'U':
+                old = old.astype(np.result_type(old, new))
+            old[targets] = new[replacing]
+            return np.concatenate([old, new[added]])
+
+        self.original_columns = [merge(old, new) for old, new in
+            zip(self.original_columns, original_columns)]
+        for key in self.COLUMNS:
+            setattr(self, key, merge(getattr(self, key), columns[key]))
+
+    def extend(self, other):
+
+        """ Adds the rows of another AllegationTable, as append does.
+        """
+
+        self.append(other.original_columns, {key: getattr(other, key) for key in self.COLUMNS})
+
+    def select(self, rows):
+
+        """ Returns a new AllegationTable holding the given rows.
+        """
+
+        selected = AllegationTable(self.header, self.officer_table)
+        selected.original_columns = [x[rows] for x in self.original_columns]
+        for key in self.COLUMNS:
+            setattr(selected, key, getattr(self, key)[rows])
+        return selected
+
+    def assignment_values(self, field, rows=slice(None)):
+
+        """ Returns the bureau, division, section, age or experience of each
+            allegation's assignment, as a list. They are 'Unassigned' for
+            UNASSIGNED allegations, and '' or 0 for MISSING_OFFICER ones.
+        """
+
+        assignment_rows = self.assignment_rows[rows]
+        categorical = field in ['bureau', 'division', 'section']
+        values = getattr(self.officer_table, field + 's')
+        if categorical:
+            values = np.array(values.categories, dtype=object)[values.codes]
+        else:
+            values = values.astype(object)
+        # Negative rows pick from the end, where -1 is UNASSIGNED and -2 is
+        # MISSING_OFFICER.
+        values = np.concatenate([values, np.array(
+            ['' if categorical else 0, 'Unassigned'], dtype=object)])
+        return values[assignment_rows].tolist()
+
+    def in_divisions(self, divisions):
+
+        """ Returns whether each allegation falls on an assignment to one of
+            divisions.
+        """
+
+        divisions = np.array([x in divisions for x in
+            self.officer_table.divisions.categories], dtype=bool)[
+            self.officer_table.divisions.codes]
+        return np.concatenate([divisions, [False, False]])[self.assignment_rows]
@@ -0,0 +1,60 @@
+import os
+import csv
+import filecmp
+import numpy as np
+
+from campaign_zero.data_preprocessing.departments import NASHVILLE
+from campaign_zero.data_preprocessing.preprocess import preprocess_department
+from campaign_zero.data_preprocessing.streaming import preprocess_department_streaming
+from campaign_zero.data_preprocessing.synthetic import generate_department
+
+
+def duplicate_allegations(allegations_filename, count, seed=0):
+
+    """ Rewrites the allegations spreadsheet with count extra rows reusing
+        earlier allegation IDs, spread through the file and with a changed
+        incident type, so the latest row's values differ from the first.
+    """
+
+    with open(allegations_filename, 'r', newline='') as openfile:
+        reader = csv.reader(openfile, delimiter=',')
+        header = next(reader)
+        rows = list(reader)
+
+    rng = np.random.default_rng(seed)
+    id_column = header.index('allegation_id')
+    type_column = header.index('incident_type')
+    for source in sorted(rng.choice(len(rows), count, replace=False).tolist(), reverse=True):
+        row = list(rows[source])
+        row[type_column] = 'Repeated'
+        target = int(rng.integers(source + 1, len(rows) + 1))
+        rows.insert(target, row)
+    assert len(set(x[id_column] for x in rows)) < len(rows)
+
+    with open(allegations_filename, 'w', newline='') as outfile:
+        writer = csv.writer(outfile, delimiter=',')
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def test_streaming_matches_full_with_duplicate_allegation_ids(tmp_path):
+
+    input_data_folder = str(tmp_path / 'input')
+    full_folder = str(tmp_path / 'full')
+    streaming_folder = str(tmp_path / 'streaming')
+    for folder in [input_data_folder, full_folder, streaming_folder]:
+        os.makedirs(folder)
+    generate_department(input_data_folder, scale=0.1, seed=1)
+    duplicate_allegations(os.path.join(input_data_folder,
+        NASHVILLE.filenames['allegations']), 101)
+
+    full = preprocess_department(NASHVILLE, input_data_folder, full_folder)
+    streaming = preprocess_department_streaming(NASHVILLE, input_data_folder,
+        streaming_folder, chunk_rows=250)
+
+    for key, output in full['outputs'].items():
+        filename = os.path.basename(output['filename'])
+        assert filecmp.cmp(os.path.join(full_folder, filename),
+            os.path.join(streaming_folder, filename), shallow=False), filename
+        assert streaming['outputs'][key]['rows'] == output['rows']
+    assert streaming['counts'] == full['counts']